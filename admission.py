@@ -0,0 +1,103 @@
+"""
+Admission control of alignment sessions. The work of a session is estimated
+from its audio duration and text length with a real-time factor learned from
+the files this node has aligned, and sessions are rejected while the backlog of
+admitted work is too long.
+"""
+
+import os
+import threading
+import time
+
+import metrics
+from learned_factor import LearnedFactor
+
+# File the learned real-time factor is kept in across restarts.
+STATE_PATH = os.environ.get("ADMISSION_STATE", "/tmp/admission.json")
+
+# Estimated seconds of backlog above which new sessions are rejected. 0
+# disables admission control.
+MAX_BACKLOG_SECONDS = float(os.environ.get("ADMISSION_MAX_BACKLOG_SECONDS", 0))
+
+# Seconds of audio that romanizing and tokenizing one character of text costs
+# as much as.
+TEXT_SECONDS_PER_CHARACTER = float(
+    os.environ.get("ADMISSION_TEXT_SECONDS_PER_CHARACTER", 0.01)
+)
+
+# Real-time factor assumed until one has been measured.
+DEFAULT_REAL_TIME_FACTOR = 0.5
+
+# Weight of a new measurement in the moving average of the real-time factor.
+SMOOTHING = 0.2
+
+# Audio bytes per second assumed when a file can't be probed (128kbps).
+BYTES_PER_AUDIO_SECOND = 16000
+
+_lock = threading.Lock()
+_backlog: dict[str, float] = {}
+_real_time_factor = LearnedFactor(
+    STATE_PATH,
+    "real_time_factor",
+    "admission.real_time_factor",
+    DEFAULT_REAL_TIME_FACTOR,
+    SMOOTHING,
+)
+
+
+def get_work(audio_seconds: float, characters: int) -> float:
+    """
+    Work of aligning audio and text, in seconds of audio.
+    """
+    return audio_seconds + characters * TEXT_SECONDS_PER_CHARACTER
+
+
+def estimate_seconds(audio_seconds: float, characters: int) -> float:
+    """
+    Estimated seconds this node takes to align audio and text.
+    """
+    return get_work(audio_seconds, characters) * _real_time_factor.get()
+
+
+def observe(audio_seconds: float, characters: int, seconds: float):
+    """
+    Update the real-time factor with the measured time of an alignment.
+    """
+    work = get_work(audio_seconds, characters)
+    if work > 0:
+        _real_time_factor.observe(seconds / work)
+
+
+def admit(session_id: str, seconds: float) -> float | None:
+    """
+    Add the estimated seconds of a session to the backlog if there is room.
+    Returns the estimated completion time, or None if the session is rejected.
+    """
+    with _lock:
+        backlog = sum(_backlog.values())
+        if MAX_BACKLOG_SECONDS and _backlog and backlog > MAX_BACKLOG_SECONDS:
+            metrics.increment("admission.rejected")
+            return None
+        _backlog[session_id] = seconds
+        metrics.set_value("admission.backlog_seconds", backlog + seconds)
+
+    metrics.increment("admission.admitted")
+    return time.time() + backlog + seconds
+
+
+def release(session_id: str):
+    """
+    Remove a session from the backlog once it stops running.
+    """
+    with _lock:
+        _backlog.pop(session_id, None)
+        metrics.set_value("admission.backlog_seconds", sum(_backlog.values()))
+
+
+def get_retry_after() -> int:
+    """
+    Seconds after which a rejected session is likely to be admitted.
+    """
+    with _lock:
+        backlog = sum(_backlog.values())
+    return max(1, int(backlog - MAX_BACKLOG_SECONDS) + 1)
@@ -0,0 +1,572 @@
+"""
+Alignment pipeline: text parsing, normalization, romanization and forced
+alignment of lines against audio, independent of where files are stored.
+"""
+
+import difflib
+import os
+import re
+import threading
+import time
+import traceback
+from typing import Any, Callable
+
+import ffmpeg
+import sox
+import torch
+from halo import Halo
+
+import metrics
+from cancellation import JobCancelled
+from mms.align_utils import (
+    ACCURATE_EMISSION_CONFIG,
+    COMPILE_MODEL,
+    DEFAULT_EMISSION_CONFIG,
+    DEVICE,
+    EmissionConfig,
+    Segment,
+    compile_model,
+    get_alignments,
+    get_coarse_to_fine_spans,
+    get_confidence,
+    get_dictionary,
+    get_model,
+    get_uroman_tokens,
+)
+from mms.text_normalization import text_normalize
+from models import DEFAULT_TIER, get_spec
+from scheduler import configure_torch_threads, stage
+from timestamp_types import Section
+
+# Maximum fraction of lines that may change for an incremental re-alignment to
+# be used instead of a full run.
+INCREMENTAL_MAX_CHANGED = 0.5
+
+# Sections of an adaptive alignment's fast pass with a confidence below this are
+# re-aligned with the accurate settings.
+ADAPTIVE_CONFIDENCE_THRESHOLD = 0.5
+
+
+# Transcripts with more romanized characters than this are aligned
+# coarse-to-fine instead of in a single pass. 0 disables it. Its timestamps
+# only approximate the single pass, so it is off until regression.py shows the
+# deviation is acceptable for the fixtures at hand.
+COARSE_TO_FINE_TOKENS = int(os.environ.get("COARSE_TO_FINE_TOKENS", 0))
+
+
+# Loaded models and dictionaries by tier, and dictionaries by path so that
+# tiers sharing a dictionary share its tokenizer.
+_models: dict[str, tuple[Any, dict[str, int]]] = {}
+_dictionaries: dict[str, dict[str, int]] = {}
+_models_lock = threading.Lock()
+
+
+def download(url: str, path: str, name: str):
+    """
+    Download a file unless it already exists.
+    """
+    spinner = Halo(text=f"Downloading {name}...").start()
+    if os.path.exists(path):
+        spinner.info(f"{name.capitalize()} already downloaded.")
+    else:
+        torch.hub.download_url_to_file(url, path)
+        spinner.succeed(f"{name.capitalize()} downloaded.")
+    assert os.path.exists(path)
+
+
+def load_model_and_dict(tier: str = DEFAULT_TIER) -> tuple[Any, dict[str, int]]:
+    """
+    Download the model and dictionary of a tier if needed and load them.
+    Loaded tiers are kept for the life of the process.
+    """
+    if tier in _models:
+        return _models[tier]
+
+    spec = get_spec(tier)
+
+    with _models_lock:
+        if tier in _models:
+            return _models[tier]
+
+        download(spec.checkpoint_url, spec.checkpoint, f"{tier} model")
+        download(spec.dictionary_url, spec.dictionary, "dictionary")
+
+        load_spinner = Halo(text=f"Loading {tier} model and dictionary...").start()
+        model = get_model(spec.checkpoint, spec.architecture, spec.quantized)
+        if spec.dictionary not in _dictionaries:
+            dictionary = get_dictionary(spec.dictionary)
+            dictionary["<star>"] = len(dictionary)
+            _dictionaries[spec.dictionary] = dictionary
+        dictionary = _dictionaries[spec.dictionary]
+        model = model.to(DEVICE)
+        configure_torch_threads()
+        load_spinner.succeed(f"{tier.capitalize()} model and dictionary loaded.")
+
+        # Quantized models run eagerly.
+        if COMPILE_MODEL and not spec.quantized:
+            compile_spinner = Halo(text="Compiling and warming up the model...").start()
+            model = compile_model(model)
+            compile_spinner.succeed("Model compiled.")
+            for name, seconds in sorted(metrics.snapshot().items()):
+                if name.startswith("inference.warm_up."):
+                    print(f"{name}: {seconds:.3f}s")
+
+        _models[tier] = model, dictionary
+
+    Halo().succeed(f"Model tier {tier} ready.")
+
+    return model, dictionary
+
+
+def convert_to_wav(
+    audio_path: str,
+    wav_path: str,
+    start: float = 0,
+    duration: float | None = None,
+):
+    """
+    Convert an audio file to a 16kHz WAV file, optionally only the part of
+    `duration` seconds from `start`.
+    """
+    # Seeking on the input only decodes the requested range.
+    input_options: dict[str, float] = {"ss": start}
+    if duration is not None:
+        input_options["t"] = duration
+
+    stream = ffmpeg.input(audio_path, **input_options)
+    stream = ffmpeg.output(stream, wav_path, acodec="pcm_s16le", ar=16000)
+    stream = ffmpeg.overwrite_output(stream)
+    ffmpeg.run(
+        stream,
+        overwrite_output=True,
+        cmd=["ffmpeg", "-loglevel", "error"],  # type: ignore
+    )
+
+
+def read_lines(text_path: str, separator: str) -> list[str]:
+    """
+    Read the lines to timestamp from a .txt or .usfm file.
+    """
+    text_extension = text_path.split(".")[-1]
+    lines_to_timestamp = []
+
+    with open(text_path, "r", encoding="utf-8") as text_file:
+        if text_extension == "txt":
+            # Read the separator from the query parameter and adjust
+            # it so it can be used in the split function.
+            if separator == "lineBreak":
+                separator = "\n"
+            elif separator == "squareBracket":
+                separator = "["
+            elif separator == "downArrow":
+                separator = "⬇️"
+
+            lines_to_timestamp = text_file.read().split(separator)
+
+            # Add back in square bracket or custom separator to the beginning of
+            # each line if it was removed.
+            if separator == "[":
+                lines_to_timestamp = [
+                    f"[{line}" for line in lines_to_timestamp if line.strip() != ""
+                ]
+            elif separator != "\n" and separator != "⬇️":
+                lines_to_timestamp = [
+                    f"{separator}{line}"
+                    for line in lines_to_timestamp
+                    if line.strip() != ""
+                ]
+        elif text_extension == "usfm":
+            # Define the tags to ignore
+            ignore_tags = [
+                "\\c",
+                "\\p",
+                "\\s",
+                "\\s1",
+                "\\s2",
+                "\\f",
+                "\\ft",
+                "\\fr",
+                "\\x",
+                "\\xt",
+                "\\xo",
+                "\\r",
+                "\\t",
+                "\\m",
+            ]
+
+            # Compile a regex to match tags we want to ignore
+            ignore_regex = re.compile(r"|".join(re.escape(tag) for tag in ignore_tags))
+            current_verse = ""
+            for line in text_file:
+                if ignore_regex.match(line.strip()):
+                    continue
+
+                if line.startswith(r"\v"):  # USFM verse marker
+                    if current_verse:
+                        cleaned_verse = re.sub(
+                            r"\\[a-z]+\s?", "", current_verse.strip()
+                        )
+                        lines_to_timestamp.append(cleaned_verse)
+                    current_verse = line.strip()  # Start a new verse
+                else:
+                    current_verse += " " + line.strip()
+
+            if current_verse:  # Append the last verse after the loop
+                cleaned_verse = re.sub(r"\\[a-z]+\s?", "", current_verse.strip())
+                lines_to_timestamp.append(cleaned_verse)
+
+    return lines_to_timestamp
+
+
+def timestamp_lines(
+    wav_path: str,
+    lines_to_timestamp: list[str],
+    language: str,
+    model: Any,
+    dictionary: Any,
+    spinner: Halo,
+    on_stage: Callable[[str], None] = lambda stage: None,
+    emission_config: EmissionConfig = DEFAULT_EMISSION_CONFIG,
+    coarse_to_fine: bool | None = None,
+) -> list[Section]:
+    """
+    Normalize, romanize and align lines of text against a 16kHz WAV file.
+
+    Lines are aligned coarse-to-fine if `coarse_to_fine` is set, or if it is
+    None and they are longer than COARSE_TO_FINE_TOKENS.
+    """
+    spinner.text = "Normalizing and romanizing... "
+    spinner.start()
+    on_stage("normalize")
+
+    with stage("text"):
+        norm_lines_to_timestamp = [
+            text_normalize(line.strip(), language) for line in lines_to_timestamp
+        ]
+        uroman_lines_to_timestamp = get_uroman_tokens(norm_lines_to_timestamp, language)
+    uroman_lines_to_timestamp = ["<star>"] + uroman_lines_to_timestamp
+    lines_to_timestamp = ["<star>"] + lines_to_timestamp
+    norm_lines_to_timestamp = ["<star>"] + norm_lines_to_timestamp
+    spinner.succeed("Text normalized and romanized.")
+
+    spinner.text = "Aligning..."
+    spinner.start()
+    on_stage("align")
+
+    if coarse_to_fine is None:
+        tokens = sum(len(line.split(" ")) for line in uroman_lines_to_timestamp)
+        coarse_to_fine = 0 < COARSE_TO_FINE_TOKENS < tokens
+
+    with stage("inference"):
+        if coarse_to_fine:
+            spans, stride, oov = get_coarse_to_fine_spans(
+                wav_path,
+                uroman_lines_to_timestamp,
+                model,
+                dictionary,
+                config=emission_config,
+            )
+        else:
+            spans, stride, oov = get_alignments(
+                wav_path,
+                uroman_lines_to_timestamp,
+                model,
+                dictionary,
+                config=emission_config,
+            )
+
+    return make_sections(
+        lines_to_timestamp, uroman_lines_to_timestamp, spans, stride, oov=oov
+    )
+
+
+def make_sections(
+    lines_to_timestamp: list[str],
+    uroman_lines_to_timestamp: list[str],
+    spans: list[list[Segment]],
+    stride: float,
+    offset: float = 0,
+    oov: dict[int, list[str]] | None = None,
+) -> list[Section]:
+    """
+    Convert the spans of each line to sections. `offset` is the time in seconds
+    of the first emission frame in the audio file, and `oov` holds the
+    characters of lines that are missing from the dictionary by line index.
+    """
+    sections = []
+
+    for i, t in enumerate(lines_to_timestamp):
+        span = spans[i]
+        seg_start_idx = span[0].start
+        seg_end_idx = span[-1].end
+
+        audio_start_sec = offset + seg_start_idx * stride / 1000
+        audio_end_sec = offset + seg_end_idx * stride / 1000
+
+        section: Section = {
+            "begin": audio_start_sec,
+            "end": audio_end_sec,
+            "begin_str": time.strftime("%H:%M:%S", time.gmtime(audio_start_sec)),
+            "end_str": time.strftime("%H:%M:%S", time.gmtime(audio_end_sec)),
+            "text": t,
+            "uroman_tokens": uroman_lines_to_timestamp[i],
+            "confidence": get_confidence(span),
+        }
+        if oov and i in oov:
+            section["oov"] = oov[i]
+
+        sections.append(section)
+
+    return sections
+
+
+def shift_sections(sections: list[Section], offset: float) -> list[Section]:
+    """
+    Return copies of sections moved by `offset` seconds.
+    """
+    if offset == 0:
+        return sections
+
+    shifted = []
+    for section in sections:
+        begin = section["begin"] + offset
+        end = section["end"] + offset
+        shifted.append(
+            {
+                **section,
+                "begin": begin,
+                "end": end,
+                "begin_str": time.strftime("%H:%M:%S", time.gmtime(begin)),
+                "end_str": time.strftime("%H:%M:%S", time.gmtime(end)),
+            }
+        )
+
+    return shifted
+
+
+def get_changed_regions(
+    previous_sections: list[Section], lines_to_timestamp: list[str]
+) -> tuple[dict[int, Section], list[tuple[int, int]]] | None:
+    """
+    Diff the new lines against the sections of a previous run, both starting
+    with the <star> line. Returns the previous sections that can be kept by
+    new line index and the ranges of new line indices that need to be
+    re-aligned, or None if too much changed for an incremental run to pay off.
+
+    Unchanged lines next to a change are re-aligned too because their
+    boundaries depend on their neighbours, as are unchanged lines that were
+    not anchored to any audio (zero duration) in the previous run.
+    """
+    previous_lines = [section["text"] for section in previous_sections]
+    matcher = difflib.SequenceMatcher(
+        None, previous_lines, lines_to_timestamp, autojunk=False
+    )
+
+    kept_sections: dict[int, Section] = {}
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != "equal":
+            continue
+        for offset in range(i2 - i1):
+            previous_section = previous_sections[i1 + offset]
+            anchored = previous_section["end"] > previous_section["begin"]
+            at_edge = (offset == 0 and j1 > 0) or (
+                offset == i2 - i1 - 1 and j2 < len(lines_to_timestamp)
+            )
+            if anchored and not at_edge:
+                kept_sections[j1 + offset] = previous_section
+
+    changed = len(lines_to_timestamp) - len(kept_sections)
+    if changed > len(lines_to_timestamp) * INCREMENTAL_MAX_CHANGED:
+        return None
+
+    return kept_sections, group_regions(kept_sections, len(lines_to_timestamp))
+
+
+def get_low_confidence_regions(
+    sections: list[Section], threshold: float
+) -> tuple[dict[int, Section], list[tuple[int, int]]]:
+    """
+    Find the sections with a confidence below `threshold`. Returns the sections
+    that can be kept by index and the ranges of indices that need to be
+    re-aligned, which include the neighbours of low-confidence sections since
+    their boundaries depend on each other.
+    """
+    low = set()
+    for index, section in enumerate(sections):
+        unanchored = section["end"] <= section["begin"]
+        if unanchored or section.get("confidence", 1) < threshold:
+            low.update([index - 1, index, index + 1])
+
+    kept_sections = {
+        index: section for index, section in enumerate(sections) if index not in low
+    }
+
+    return kept_sections, group_regions(kept_sections, len(sections))
+
+
+def group_regions(kept: dict[int, Section], length: int) -> list[tuple[int, int]]:
+    """
+    Group the indices below `length` that are not in `kept` into ranges of
+    consecutive indices.
+    """
+    regions = []
+    start = None
+    for index in range(length + 1):
+        is_kept = index == length or index in kept
+        if not is_kept and start is None:
+            start = index
+        elif is_kept and start is not None:
+            regions.append((start, index))
+            start = None
+
+    return regions
+
+
+def realign_lines(
+    wav_path: str,
+    previous_sections: list[Section],
+    lines_to_timestamp: list[str],
+    language: str,
+    model: Any,
+    dictionary: Any,
+    spinner: Halo,
+    on_stage: Callable[[str], None] = lambda stage: None,
+) -> list[Section] | None:
+    """
+    Re-align only the lines that changed since a previous run against the
+    same audio. Returns None if a full run is needed instead.
+    """
+    lines_to_timestamp = ["<star>"] + lines_to_timestamp
+    diff = get_changed_regions(previous_sections, lines_to_timestamp)
+
+    if diff is None:
+        return None
+
+    kept_sections, regions = diff
+
+    return realign_regions(
+        wav_path,
+        lines_to_timestamp,
+        kept_sections,
+        regions,
+        language,
+        model,
+        dictionary,
+        spinner,
+        on_stage,
+    )
+
+
+def refine_sections(
+    wav_path: str,
+    sections: list[Section],
+    language: str,
+    model: Any,
+    dictionary: Any,
+    spinner: Halo,
+    on_stage: Callable[[str], None] = lambda stage: None,
+) -> list[Section]:
+    """
+    Re-align the low-confidence sections of a fast pass with the accurate
+    emission settings, leaving confident sections untouched.
+    """
+    kept_sections, regions = get_low_confidence_regions(
+        sections, ADAPTIVE_CONFIDENCE_THRESHOLD
+    )
+
+    if len(regions) == 0:
+        return sections
+
+    refined = realign_regions(
+        wav_path,
+        [section["text"] for section in sections],
+        kept_sections,
+        regions,
+        language,
+        model,
+        dictionary,
+        spinner,
+        on_stage,
+        ACCURATE_EMISSION_CONFIG,
+    )
+
+    return sections if refined is None else refined
+
+
+def realign_regions(
+    wav_path: str,
+    lines_to_timestamp: list[str],
+    kept_sections: dict[int, Section],
+    regions: list[tuple[int, int]],
+    language: str,
+    model: Any,
+    dictionary: Any,
+    spinner: Halo,
+    on_stage: Callable[[str], None] = lambda stage: None,
+    emission_config: EmissionConfig = DEFAULT_EMISSION_CONFIG,
+) -> list[Section] | None:
+    """
+    Re-align the given ranges of lines, starting with the <star> line, keeping
+    the other sections. Only the audio between the kept sections around a
+    region is decoded and aligned. Returns None if a region can't be aligned.
+    """
+    sections: list[Section | None] = [
+        kept_sections.get(i) for i in range(len(lines_to_timestamp))
+    ]
+    audio_duration = sox.file_info.duration(wav_path)
+
+    for start, end in regions:
+        spinner.text = f"Re-aligning lines {start} to {end - 1}..."
+        spinner.start()
+        on_stage("normalize")
+
+        region_lines = lines_to_timestamp[start:end]
+        # The <star> line is only normalized as part of a full run.
+        has_star = start == 0
+        text_lines = region_lines[1:] if has_star else region_lines
+        with stage("text"):
+            uroman_lines = get_uroman_tokens(
+                [text_normalize(line.strip(), language) for line in text_lines],
+                language,
+            )
+        # Every region is aligned with a leading <star> so that audio between
+        # the previous anchor and the first re-aligned line is absorbed by it.
+        uroman_lines = ["<star>"] + uroman_lines
+        text_lines = ["<star>"] + text_lines
+
+        region_start = sections[start - 1]["end"] if start > 0 else 0  # type: ignore
+        region_end = (
+            sections[end]["begin"]  # type: ignore
+            if end < len(lines_to_timestamp)
+            else audio_duration
+        )
+
+        on_stage("align")
+        try:
+            with stage("inference"):
+                spans, stride, oov = get_alignments(
+                    wav_path,
+                    uroman_lines,
+                    model,
+                    dictionary,
+                    region_start,
+                    region_end,
+                    emission_config,
+                )
+        except JobCancelled:
+            # A cancelled job stops instead of keeping the previous sections.
+            raise
+        except Exception:
+            print(traceback.format_exc())
+            spinner.fail(f"Failed to re-align lines {start} to {end - 1}.")
+            return None
+
+        region_sections = make_sections(
+            text_lines, uroman_lines, spans, stride, region_start, oov
+        )
+        if not has_star:
+            region_sections = region_sections[1:]
+        sections[start:end] = region_sections
+        spinner.succeed(f"Re-aligned lines {start} to {end - 1}.")
+
+    return sections  # type: ignore
@@ -0,0 +1,109 @@
+"""
+ASGI entry point serving the same routes as the Flask app from a single
+process:
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8000
+
+Progress streams are served on the event loop without holding a thread. Every
+other request runs the Flask app on a thread pool through a2wsgi, so the loop
+never blocks on storage, Firestore, ffmpeg or the models, and request bodies
+are streamed to the handlers as they arrive.
+"""
+
+import asyncio
+import os
+from contextlib import suppress
+from typing import AsyncIterator, Callable
+from urllib.parse import parse_qs
+
+from a2wsgi import WSGIMiddleware
+
+from events import astream
+from main import app as flask_app
+
+# Threads running Flask handlers, i.e. the number of requests other than
+# progress streams that are handled at once.
+ASGI_THREADS = int(os.environ.get("ASGI_THREADS", 64))
+
+wsgi_app = WSGIMiddleware(flask_app, workers=ASGI_THREADS)
+
+
+async def wait_for_disconnect(receive: Callable):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def forward_events(events: AsyncIterator[str], send: Callable):
+    async for chunk in events:
+        await send(
+            {"type": "http.response.body", "body": chunk.encode(), "more_body": True}
+        )
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def send_text(send: Callable, status: int, text: str):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"text/html; charset=utf-8")],
+        }
+    )
+    await send({"type": "http.response.body", "body": text.encode()})
+
+
+async def session_events(scope: dict, receive: Callable, send: Callable):
+    """
+    The /events route of main.py, on the event loop.
+    """
+    session_id = parse_qs(scope["query_string"].decode()).get("session-id", [None])[0]
+
+    if session_id is None:
+        await send_text(send, 400, "Missing session-id parameter")
+        return
+
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream; charset=utf-8"),
+                (b"cache-control", b"no-cache"),
+                (b"x-accel-buffering", b"no"),
+                (b"access-control-allow-origin", b"*"),
+                (b"access-control-allow-methods", b"GET"),
+            ],
+        }
+    )
+
+    events = astream(session_id)
+    # The stream is read by a single task. Cancelling it on a disconnect closes
+    # the generator, so that no read of it is pending when it is closed below.
+    forward = asyncio.ensure_future(forward_events(events, send))
+    disconnect = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        await asyncio.wait({forward, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+        if forward.done():
+            forward.result()
+    finally:
+        for task in (forward, disconnect):
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+        await events.aclose()
+
+
+async def app(scope: dict, receive: Callable, send: Callable):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    elif scope["type"] == "http":
+        if scope["path"] == "/events":
+            await session_events(scope, receive, send)
+        else:
+            await wsgi_app(scope, receive, send)
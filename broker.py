@@ -0,0 +1,268 @@
+"""
+Job brokers used to distribute alignment jobs across worker processes and
+machines.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from typing import Any, TypedDict
+
+# Seconds after the last heartbeat from which a running job is considered
+# abandoned by a crashed worker and is put back in the queue.
+STALE_AFTER = 60
+
+# Number of times a job is handed out before it is given up on, so that a job
+# that crashes every worker doesn't loop forever.
+MAX_ATTEMPTS = 3
+
+
+class Job(TypedDict):
+    """
+    An alignment job claimed from a broker.
+    """
+
+    id: str
+    session_id: str
+    payload: dict[str, Any]
+    attempts: int
+
+
+class Broker(ABC):
+    """
+    Queue of alignment jobs shared by the processes that enqueue and run them.
+    """
+
+    @abstractmethod
+    def enqueue(self, session_id: str, payload: dict[str, Any]) -> str:
+        """
+        Add a job to the queue and return its ID.
+        """
+
+    @abstractmethod
+    def claim(self, worker_id: str) -> Job | None:
+        """
+        Take the oldest queued job, or return None if there is none.
+        """
+
+    @abstractmethod
+    def heartbeat(self, job_id: str, worker_id: str) -> bool:
+        """
+        Signal that a worker is still running a job. Returns False if the job
+        no longer belongs to the worker.
+        """
+
+    @abstractmethod
+    def complete(self, job_id: str, worker_id: str, failed: bool = False):
+        """
+        Mark a job of a worker as done or failed. Does nothing if the job no
+        longer belongs to the worker.
+        """
+
+    @abstractmethod
+    def release(self, job_id: str, worker_id: str):
+        """
+        Put a running job of a worker back in the queue. Does nothing if the
+        job no longer belongs to the worker.
+        """
+
+    @abstractmethod
+    def cancel(self, session_id: str) -> str | None:
+        """
+        Cancel the job of a session. Queued jobs are removed from the queue and
+        running jobs are flagged for their worker to stop. Returns the status
+        the job had ("queued" or "running"), or None if there was none.
+        """
+
+    @abstractmethod
+    def is_cancel_requested(self, job_id: str) -> bool:
+        """
+        Whether a running job was cancelled with `cancel`.
+        """
+
+    @abstractmethod
+    def release_stale(self) -> list[Job]:
+        """
+        Put jobs of workers that stopped sending heartbeats back in the queue,
+        and give up on those that ran out of attempts. Returns the jobs that
+        were given up on.
+        """
+
+
+class SQLiteBroker(Broker):
+    """
+    Broker backed by a SQLite database file. Every process that opens the same
+    file shares the queue, so workers on other machines need the file on a
+    shared volume with working file locks.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+        connection = self._connect()
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                session_id TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                worker TEXT,
+                heartbeat REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                cancel_requested INTEGER NOT NULL DEFAULT 0,
+                created REAL NOT NULL
+            )
+            """)
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)"
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        # Connections can't be shared between threads, so each thread that
+        # uses the broker (e.g. a heartbeat thread) gets its own.
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self._local.connection = connection
+        return connection
+
+    def enqueue(self, session_id: str, payload: dict[str, Any]) -> str:
+        job_id = uuid.uuid4().hex
+        self._connect().execute(
+            "INSERT INTO jobs (id, session_id, payload, status, created) "
+            "VALUES (?, ?, ?, 'queued', ?)",
+            (job_id, session_id, json.dumps(payload), time.time()),
+        )
+        return job_id
+
+    def claim(self, worker_id: str) -> Job | None:
+        connection = self._connect()
+        # BEGIN IMMEDIATE takes the write lock up front so that two workers
+        # can't select the same queued job.
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT id, session_id, payload, attempts FROM jobs "
+                "WHERE status = 'queued' ORDER BY created LIMIT 1"
+            ).fetchone()
+            if row is None:
+                connection.execute("COMMIT")
+                return None
+
+            connection.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, heartbeat = ?, "
+                "attempts = attempts + 1 WHERE id = ?",
+                (worker_id, time.time(), row[0]),
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+        return {
+            "id": row[0],
+            "session_id": row[1],
+            "payload": json.loads(row[2]),
+            "attempts": row[3] + 1,
+        }
+
+    def heartbeat(self, job_id: str, worker_id: str) -> bool:
+        cursor = self._connect().execute(
+            "UPDATE jobs SET heartbeat = ? "
+            "WHERE id = ? AND worker = ? AND status = 'running'",
+            (time.time(), job_id, worker_id),
+        )
+        return cursor.rowcount == 1
+
+    def complete(self, job_id: str, worker_id: str, failed: bool = False):
+        self._connect().execute(
+            "UPDATE jobs SET status = ? WHERE id = ? AND worker = ?",
+            ("failed" if failed else "done", job_id, worker_id),
+        )
+
+    def release(self, job_id: str, worker_id: str):
+        self._connect().execute(
+            "UPDATE jobs SET status = 'queued', worker = NULL "
+            "WHERE id = ? AND worker = ?",
+            (job_id, worker_id),
+        )
+
+    def cancel(self, session_id: str) -> str | None:
+        connection = self._connect()
+        cursor = connection.execute(
+            "UPDATE jobs SET status = 'cancelled' "
+            "WHERE session_id = ? AND status = 'queued'",
+            (session_id,),
+        )
+        if cursor.rowcount > 0:
+            return "queued"
+
+        cursor = connection.execute(
+            "UPDATE jobs SET cancel_requested = 1 "
+            "WHERE session_id = ? AND status = 'running'",
+            (session_id,),
+        )
+        return "running" if cursor.rowcount > 0 else None
+
+    def is_cancel_requested(self, job_id: str) -> bool:
+        row = (
+            self._connect()
+            .execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,))
+            .fetchone()
+        )
+        return row is not None and row[0] == 1
+
+    def release_stale(self) -> list[Job]:
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            stale_before = time.time() - STALE_AFTER
+            abandoned = connection.execute(
+                "SELECT id, session_id, payload, attempts FROM jobs "
+                "WHERE status = 'running' AND heartbeat < ? AND attempts >= ?",
+                (stale_before, MAX_ATTEMPTS),
+            ).fetchall()
+            connection.execute(
+                "UPDATE jobs SET status = 'failed' "
+                "WHERE status = 'running' AND heartbeat < ? AND attempts >= ?",
+                (stale_before, MAX_ATTEMPTS),
+            )
+            connection.execute(
+                "UPDATE jobs SET status = 'queued', worker = NULL "
+                "WHERE status = 'running' AND heartbeat < ?",
+                (stale_before,),
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+        return [
+            {
+                "id": row[0],
+                "session_id": row[1],
+                "payload": json.loads(row[2]),
+                "attempts": row[3],
+            }
+            for row in abandoned
+        ]
+
+
+def get_broker() -> Broker | None:
+    """
+    Broker configured with the JOB_BROKER environment variable, e.g.
+    "sqlite:///var/lib/timestamper/jobs.db", or None to run jobs in-process.
+    """
+    url = os.environ.get("JOB_BROKER")
+
+    if not url:
+        return None
+    elif url.startswith("sqlite://"):
+        return SQLiteBroker(url.removeprefix("sqlite://"))
+
+    raise ValueError(f"Unsupported job broker: {url}")
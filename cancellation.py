@@ -0,0 +1,164 @@
+"""
+Cancellation and time budgets of alignment jobs. A job's token is active on
+the thread that runs it, and the pipeline checks it between stages and between
+emission windows.
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+# Wall-clock seconds and seconds of audio a job may take before it is
+# cancelled. 0 disables a budget.
+JOB_MAX_SECONDS = float(os.environ.get("JOB_MAX_SECONDS", 0))
+JOB_MAX_AUDIO_SECONDS = float(os.environ.get("JOB_MAX_AUDIO_SECONDS", 0))
+
+_lock = threading.Lock()
+_tokens: dict[str, "CancelToken"] = {}
+_local = threading.local()
+
+
+class JobCancelled(Exception):
+    """
+    Raised in a job that was cancelled or ran out of budget.
+    """
+
+
+class JobReassigned(JobCancelled):
+    """
+    Raised in a job that another worker took over. The session belongs to the
+    new owner, so the job stops without reporting anything.
+    """
+
+
+class CancelToken:
+    """
+    Cancellation state and budgets of one job.
+    """
+
+    def __init__(self):
+        self.reason: str | None = None
+        # Set by `start` when the job starts running, so that time spent
+        # queued doesn't count towards the budget.
+        self.deadline: float | None = None
+        self.audio_seconds = 0.0
+        self.reassigned = False
+
+    def start(self):
+        """
+        Start the job's time budget.
+        """
+        if JOB_MAX_SECONDS and self.deadline is None:
+            self.deadline = time.time() + JOB_MAX_SECONDS
+
+    def cancel(self, reason: str = "Cancelled by user."):
+        if self.reason is None:
+            self.reason = reason
+
+    def reassign(self):
+        """
+        Stop a job that another worker took over.
+        """
+        self.reassigned = True
+        self.cancel("The job was reassigned to another worker.")
+
+    def check(self):
+        """
+        Raise JobCancelled if the job was cancelled or is past its deadline.
+        """
+        if self.deadline is not None and time.time() > self.deadline:
+            self.cancel(f"Exceeded the time budget of {JOB_MAX_SECONDS:.0f}s.")
+        if self.reassigned:
+            raise JobReassigned(self.reason)
+        if self.reason is not None:
+            raise JobCancelled(self.reason)
+
+    def add_audio(self, seconds: float):
+        """
+        Count audio towards the job's budget, raising JobCancelled if it is
+        exceeded.
+        """
+        self.audio_seconds += seconds
+        if JOB_MAX_AUDIO_SECONDS and self.audio_seconds > JOB_MAX_AUDIO_SECONDS:
+            self.cancel(f"Exceeded the audio budget of {JOB_MAX_AUDIO_SECONDS:.0f}s.")
+        self.check()
+
+
+def register_job(session_id: str) -> CancelToken:
+    """
+    Create the token of a session's job so that it can be cancelled before
+    and while it runs.
+    """
+    token = CancelToken()
+    with _lock:
+        _tokens[session_id] = token
+    return token
+
+
+def cancel_job(session_id: str) -> bool:
+    """
+    Cancel the job of a session in this process. Returns whether there was one.
+    """
+    with _lock:
+        token = _tokens.get(session_id)
+    if token is None:
+        return False
+    token.cancel()
+    return True
+
+
+def get_token() -> CancelToken | None:
+    """
+    Token of the job running on the current thread, if any.
+    """
+    return getattr(_local, "token", None)
+
+
+@contextmanager
+def use_token(token: CancelToken | None) -> Iterator[None]:
+    """
+    Make a token the active one of the current thread, e.g. in threads that
+    work on a part of a job.
+    """
+    previous = get_token()
+    _local.token = token
+    try:
+        yield
+    finally:
+        _local.token = previous
+
+
+@contextmanager
+def run_with_token(session_id: str, token: CancelToken) -> Iterator[None]:
+    """
+    Make a token the active one of the current thread while a job runs,
+    starting its time budget, and unregister it afterwards.
+    """
+    token.start()
+    try:
+        with use_token(token):
+            yield
+    finally:
+        with _lock:
+            if _tokens.get(session_id) is token:
+                del _tokens[session_id]
+
+
+def check_cancelled():
+    """
+    Raise JobCancelled if the job running on the current thread was cancelled.
+    """
+    token = get_token()
+    if token is not None:
+        token.check()
+
+
+def add_audio(seconds: float):
+    """
+    Count audio towards the budget of the job running on the current thread.
+    """
+    token = get_token()
+    if token is not None:
+        token.add_audio(seconds)
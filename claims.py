@@ -0,0 +1,102 @@
+"""
+Claiming of sessions so that each one is aligned at most once at a time, across
+workers and within a process.
+"""
+
+import os
+import threading
+import time
+from typing import Any
+
+from firebase_admin import firestore
+
+from firebase import db
+from timestamp_types import Status
+
+# Seconds after which an in-progress claim is considered left behind by a run
+# that crashed, so the session can be claimed again. 0 never reclaims.
+CLAIM_STALE_SECONDS = float(os.environ.get("CLAIM_STALE_SECONDS", 24 * 3600))
+
+_lock = threading.Lock()
+# Request parameters of the sessions that are being aligned by this process.
+_running: dict[str, dict[str, Any]] = {}
+
+
+def is_claimable(session_doc: dict[str, Any] | None) -> bool:
+    """
+    Whether a session with this document may be claimed: it isn't in progress,
+    or its claim is older than CLAIM_STALE_SECONDS.
+    """
+    if session_doc is None or session_doc.get("status") != Status.IN_PROGRESS.value:
+        return True
+    return (
+        CLAIM_STALE_SECONDS > 0
+        and time.time() - (session_doc.get("start") or 0) > CLAIM_STALE_SECONDS
+    )
+
+
+def _claim(
+    transaction: Any, session_doc_ref: Any, fields: dict[str, Any]
+) -> tuple[bool, dict[str, Any] | None]:
+    snapshot = session_doc_ref.get(transaction=transaction)
+    session_doc = snapshot.to_dict() if snapshot.exists else None
+
+    if not is_claimable(session_doc):
+        return False, session_doc
+
+    transaction.set(session_doc_ref, fields, merge=True)
+    return True, session_doc
+
+
+_claim_in_transaction = firestore.transactional(_claim)
+
+
+def claim_session(
+    session_doc_ref: Any, fields: dict[str, Any]
+) -> tuple[bool, dict[str, Any] | None]:
+    """
+    Atomically mark a session as in progress, writing `fields` to its
+    document, unless it already is. Returns whether the session was claimed and
+    the document as it was before the claim.
+
+    The read and the write happen in one Firestore transaction, so two workers
+    receiving the same request at once can't both claim the session.
+    """
+    return _claim_in_transaction(db.transaction(), session_doc_ref, fields)
+
+
+def claim_local_session(
+    documents: dict[str, dict[str, Any]], session_id: str, fields: dict[str, Any]
+) -> tuple[bool, dict[str, Any] | None]:
+    """
+    Stand-in for `claim_session` backed by an in-memory dictionary of
+    documents, for running without Firestore, e.g. in tests.
+    """
+    with _lock:
+        session_doc = documents.get(session_id)
+
+        if not is_claimable(session_doc):
+            return False, dict(session_doc or {})
+
+        documents[session_id] = {**(session_doc or {}), **fields}
+        return True, None if session_doc is None else dict(session_doc)
+
+
+def start_job(session_id: str, parameters: dict[str, Any]) -> dict[str, Any] | None:
+    """
+    Register a job for a session in this process. Returns None if the job was
+    registered, or the parameters of the job already running for the session.
+    """
+    with _lock:
+        if session_id in _running:
+            return _running[session_id]
+        _running[session_id] = parameters
+        return None
+
+
+def finish_job(session_id: str):
+    """
+    Unregister the job of a session registered with `start_job`.
+    """
+    with _lock:
+        _running.pop(session_id, None)
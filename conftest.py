@@ -0,0 +1,13 @@
+"""
+Shared test setup. The `firebase` module connects to the production project
+when it is imported, so tests get a stand-in without a database or bucket.
+Modules that need them are tested with fakes passed in explicitly.
+"""
+
+import sys
+import types
+
+firebase = types.ModuleType("firebase")
+firebase.db = None  # type: ignore[attr-defined]
+firebase.bucket = None  # type: ignore[attr-defined]
+sys.modules["firebase"] = firebase
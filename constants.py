@@ -4,3 +4,6 @@ model_url = (
 )
 dict_name = "ctc_alignment_mling_uroman_model.dict"
 dict_url = "https://dl.fbaipublicfiles.com/mms/torchaudio/ctc_alignment_mling_uroman/dictionary.txt"
+# Identifies the checkpoint and dictionary above. Change it whenever either of
+# them changes so that cached alignments from the previous model are ignored.
+model_version = "ctc_alignment_mling_uroman"
@@ -2,25 +2,22 @@ import os
 
 import torch
 
-from constants import dict_name, dict_url, model_name, model_url
+from models import MODELS
 
-print("Downloading model...")
-if os.path.exists(model_name):
-    print("Already downloaded.")
-else:
-    torch.hub.download_url_to_file(
-        model_url,
-        model_name,
-    )
-assert os.path.exists(model_name)
-print("Model downloaded.")
+# Tiers share checkpoints and dictionaries, which are downloaded once.
+files = {}
+for spec in MODELS.values():
+    files[spec.checkpoint] = spec.checkpoint_url
+    files[spec.dictionary] = spec.dictionary_url
 
-print("Downloading dictionary...")
-if os.path.exists(dict_name):
-    print("Already downloaded.")
-else:
-    torch.hub.download_url_to_file(
-        dict_url,
-        dict_name,
-    )
-print("Dictionary downloaded.")
+for path, url in files.items():
+    print(f"Downloading {path}...")
+    if os.path.exists(path):
+        print("Already downloaded.")
+    else:
+        torch.hub.download_url_to_file(
+            url,
+            path,
+        )
+    assert os.path.exists(path)
+    print(f"{path} downloaded.")
@@ -0,0 +1,169 @@
+"""
+In-process event bus used to stream session progress to clients.
+"""
+
+import asyncio
+import json
+import os
+import queue
+import threading
+import time
+from typing import Any, AsyncIterator, Iterator
+
+from timestamp_types import ProgressEvent
+
+# Events that end a session run. Streams are closed after sending one.
+TERMINAL_EVENTS = {"done", "failed", "cancelled"}
+
+# Maximum number of events kept per session so late subscribers can catch up.
+HISTORY_LIMIT = 1000
+
+# Seconds the history of a finished session is kept for late subscribers.
+HISTORY_TTL = float(os.environ.get("EVENT_HISTORY_TTL", 300))
+
+# Seconds between keep-alive comments on an idle stream.
+KEEP_ALIVE_INTERVAL = 15
+
+_lock = threading.Lock()
+# Subscribers are anything with a thread-safe `put` method.
+_subscribers: dict[str, list[Any]] = {}
+_history: dict[str, list[ProgressEvent]] = {}
+# Time of the terminal event of finished sessions that still have a history.
+_finished: dict[str, float] = {}
+
+
+def _expire_history(now: float):
+    """
+    Drop the histories of sessions that finished more than HISTORY_TTL
+    seconds ago. Must be called with the lock held.
+    """
+    for session_id, finished in list(_finished.items()):
+        if now - finished > HISTORY_TTL:
+            del _finished[session_id]
+            _history.pop(session_id, None)
+
+
+def publish(session_id: str, event: str, data: dict[str, Any] | None = None):
+    """
+    Publish an event for a session to every current subscriber.
+
+    A "started" event resets the stored history so that subscribers of a
+    restarted session only replay events of the current run.
+    """
+    progress_event: ProgressEvent = {
+        "event": event,
+        "time": time.time(),
+        "data": data or {},
+    }
+
+    with _lock:
+        _expire_history(progress_event["time"])
+        if event == "started":
+            _history[session_id] = []
+            _finished.pop(session_id, None)
+        elif event in TERMINAL_EVENTS:
+            _finished[session_id] = progress_event["time"]
+        history = _history.setdefault(session_id, [])
+        history.append(progress_event)
+        del history[:-HISTORY_LIMIT]
+        subscribers = list(_subscribers.get(session_id, []))
+
+    for subscriber in subscribers:
+        subscriber.put(progress_event)
+
+
+class LoopQueue:
+    """
+    Queue read by a coroutine on an event loop and fed from any thread.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue()
+
+    def put(self, progress_event: ProgressEvent):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, progress_event)
+
+
+def subscribe(session_id: str, subscriber: Any = None) -> Any:
+    """
+    Subscribe to the events of a session, into a new queue.Queue by default.
+    Past events of the current run are replayed into the subscriber first.
+    """
+    if subscriber is None:
+        subscriber = queue.Queue()
+
+    with _lock:
+        _expire_history(time.time())
+        for progress_event in _history.get(session_id, []):
+            subscriber.put(progress_event)
+        _subscribers.setdefault(session_id, []).append(subscriber)
+
+    return subscriber
+
+
+def unsubscribe(session_id: str, subscriber: Any):
+    """
+    Remove a subscriber added with `subscribe`.
+    """
+    with _lock:
+        subscribers = _subscribers.get(session_id, [])
+        if subscriber in subscribers:
+            subscribers.remove(subscriber)
+        if len(subscribers) == 0:
+            _subscribers.pop(session_id, None)
+
+
+def format_event(progress_event: ProgressEvent) -> str:
+    """
+    Format an event as a server-sent event.
+    """
+    payload = json.dumps({"time": progress_event["time"], **progress_event["data"]})
+    return f"event: {progress_event['event']}\ndata: {payload}\n\n"
+
+
+def stream(session_id: str) -> Iterator[str]:
+    """
+    Yield the events of a session formatted as server-sent events until the
+    session is done, failed or cancelled.
+    """
+    subscriber = subscribe(session_id)
+
+    try:
+        while True:
+            try:
+                progress_event = subscriber.get(timeout=KEEP_ALIVE_INTERVAL)
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+
+            yield format_event(progress_event)
+
+            if progress_event["event"] in TERMINAL_EVENTS:
+                return
+    finally:
+        unsubscribe(session_id, subscriber)
+
+
+async def astream(session_id: str) -> AsyncIterator[str]:
+    """
+    Like `stream`, without holding a thread while waiting for events.
+    """
+    subscriber = subscribe(session_id, LoopQueue())
+
+    try:
+        while True:
+            try:
+                progress_event = await asyncio.wait_for(
+                    subscriber.queue.get(), KEEP_ALIVE_INTERVAL
+                )
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+
+            yield format_event(progress_event)
+
+            if progress_event["event"] in TERMINAL_EVENTS:
+                return
+    finally:
+        unsubscribe(session_id, subscriber)
@@ -0,0 +1,59 @@
+"""
+Factors of cost models learned from measurements, kept across restarts.
+"""
+
+import json
+import os
+import threading
+from pathlib import Path
+
+import metrics
+
+
+class LearnedFactor:
+    """
+    A factor learned as an exponential moving average of measured values,
+    persisted to a JSON file and reported as a metric.
+    """
+
+    def __init__(
+        self, path: str, key: str, metric: str, default: float, smoothing: float
+    ):
+        self.path = path
+        # Key of the factor in the JSON file.
+        self.key = key
+        self.metric = metric
+        self.default = default
+        # Weight of a new measurement in the moving average.
+        self.smoothing = smoothing
+        self.value: float | None = None
+        self.lock = threading.Lock()
+
+    def _load(self) -> float:
+        if self.value is None:
+            try:
+                with open(self.path) as f:
+                    self.value = float(json.load(f)[self.key])
+            except (OSError, ValueError, KeyError, TypeError):
+                self.value = self.default
+        return self.value
+
+    def get(self) -> float:
+        with self.lock:
+            return self._load()
+
+    def observe(self, measurement: float):
+        """
+        Move the factor towards a measured value and persist it.
+        """
+        with self.lock:
+            value = (1 - self.smoothing) * self._load() + self.smoothing * measurement
+            self.value = value
+
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            temporary_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(temporary_path, "w") as f:
+                json.dump({self.key: value}, f)
+            os.replace(temporary_path, self.path)
+
+        metrics.set_value(self.metric, value)
@@ -40,3 +40,61 @@ def identify_language(audio_path: str):
     language = model.config.id2label[int(predicted_id)]
 
     return language
+
+
+# Maximum number of clips run through the model in one forward pass
+BATCH_SIZE = 16
+
+
+# Function to identify the languages of several audio files, batched
+def identify_languages(
+    audio_paths: list[str], top_k: int = 3
+) -> list[list[tuple[str, float]]]:
+    results = []
+
+    for start in range(0, len(audio_paths), BATCH_SIZE):
+        waveforms = [
+            load_audio(audio_path)[0].numpy()
+            for audio_path in audio_paths[start : start + BATCH_SIZE]
+        ]
+
+        # Shorter clips are padded, and masked out through the attention mask
+        inputs = processor(
+            waveforms,
+            sampling_rate=16000,
+            return_tensors="pt",
+            padding=True,
+            return_attention_mask=True,
+        )
+
+        with torch.no_grad():
+            probabilities = torch.softmax(model(**inputs).logits, dim=-1)
+
+        # The most likely languages of each file with their probabilities
+        scores, ids = probabilities.topk(min(top_k, probabilities.size(-1)), dim=-1)
+        results.extend(
+            [
+                (model.config.id2label[int(id_)], float(score))
+                for id_, score in zip(file_ids, file_scores)
+            ]
+            for file_ids, file_scores in zip(ids, scores)
+        )
+
+    return results
+
+
+# Language most likely across files, with the fraction of files that agree
+def get_consensus(languages: list[list[tuple[str, float]]]) -> tuple[str | None, float]:
+    totals: dict[str, float] = {}
+    for file_languages in languages:
+        for language, score in file_languages:
+            totals[language] = totals.get(language, 0) + score
+
+    if not totals:
+        return None, 0
+
+    consensus = max(totals, key=lambda language: totals[language])
+    agreement = sum(
+        1 for file_languages in languages if file_languages[0][0] == consensus
+    ) / len(languages)
+    return consensus, agreement
@@ -1,51 +1,215 @@
+import json
 import os
+import shutil
 import time
+import traceback
+import uuid
 from multiprocessing.dummy import Pool
-from pathlib import Path
+from typing import Any, Mapping
 
 import ffmpeg
 import flask
-import torch
 from flask import Flask, request
 from halo import Halo
 
-from constants import dict_name, dict_url, model_name, model_url
+import admission
+import metrics
+from alignment import load_model_and_dict
+from broker import get_broker
+from cancellation import CancelToken, cancel_job, register_job, run_with_token
+from claims import claim_session, finish_job, start_job
+from events import publish, stream
 from firebase import bucket, db
-from lid import identify_language
-from mms.align_utils import DEVICE, get_model_and_dict
-from timestamp_types import File, Status
-from utils import align_matches, match_files
+from lid import get_consensus, identify_language, identify_languages
+from models import DEFAULT_TIER, get_tiers
+from profiling import get_profile_folder, is_valid_name, list_profile_files, profile_job
+from scheduler import STAGE_SLOTS, stage
+from scratch import clean_orphans, scratch_space
+from timestamp_types import AudioRange, File, Status
+from uploads import AUDIO_EXTENSIONS, UploadError, receive_upload
+from utils import align_matches, estimate_matches, match_files, probe_durations
 
 pool = Pool(10)
 app = Flask(__name__)
 
-model_spinner = Halo(text="Downloading model...").start()
-if os.path.exists(model_name):
-    model_spinner.info("Model already downloaded.")
-else:
-    torch.hub.download_url_to_file(
-        model_url,
-        model_name,
+clean_orphans()
+
+broker = get_broker()
+# With a broker, alignment runs in separate worker processes (see worker.py),
+# so the web process doesn't need the model. Other tiers are loaded on demand.
+if broker is None:
+    load_model_and_dict()
+
+# Folder that direct uploads are received into. With a broker it has to be
+# reachable by the workers.
+UPLOAD_DIR = os.environ.get("UPLOAD_DIR", "/tmp/uploads")
+
+# Without a broker, uploads are only used by this process, and those of
+# processes that are no longer running belong to jobs that will never run.
+if broker is None:
+    clean_orphans([UPLOAD_DIR])
+
+# Seconds at the start of a file that its language is identified from.
+LID_SECONDS = 20
+
+
+def run_alignment(session_id: str, token: CancelToken, profile: bool, **kwargs):
+    """
+    Run `align_matches` for a session registered with `start_job`, writing
+    profiling traces if `profile` is set.
+    """
+    try:
+        with run_with_token(session_id, token), profile_job(session_id, profile):
+            align_matches(session_id, **kwargs)
+    finally:
+        admission.release(session_id)
+        finish_job(session_id)
+
+
+def run_batch(jobs: list[tuple[str, CancelToken, bool, Any, dict]]):
+    """
+    Run the sessions of a batch one after another with `run_alignment`.
+    """
+    for session_id, token, profile, session_doc_ref, options in jobs:
+        try:
+            run_alignment(
+                session_id,
+                token,
+                profile,
+                session_doc_ref=session_doc_ref,
+                **options,
+            )
+        except Exception as e:
+            # A failed session must not keep the rest of the batch waiting.
+            print(traceback.format_exc())
+            try:
+                session_doc_ref.set(
+                    {
+                        "status": Status.FAILED.value,
+                        "error": str(e),
+                        "end": time.time(),
+                    },
+                    merge=True,
+                )
+            except Exception:
+                print(traceback.format_exc())
+            publish(session_id, "failed", {"error": str(e)})
+
+
+def attach_response(same_request: bool):
+    """
+    Response to a request for a session that is already being aligned.
+    """
+    if not same_request:
+        return "Session already in progress", 400
+
+    response = flask.jsonify(
+        {"message": "Alignment already running.", "attached": True}
     )
-    model_spinner.succeed("Model downloaded.")
-assert os.path.exists(model_name)
-
-dict_spinner = Halo(text="Downloading dictionary...").start()
-if os.path.exists(dict_name):
-    dict_spinner.info("Dictionary already downloaded.")
-else:
-    torch.hub.download_url_to_file(
-        dict_url,
-        dict_name,
+    response.headers.add("Access-Control-Allow-Origin", "*")
+    response.headers.add("Access-Control-Allow-Methods", "GET")
+    return response
+
+
+def admit_session(session_id: str, estimate: float) -> float | None:
+    """
+    Admit a session estimated to take `estimate` seconds. Returns its
+    estimated completion time, or None if this node is too busy.
+    """
+    if broker is not None:
+        # Queued jobs wait for any worker, so there is no local backlog to
+        # reject on.
+        return time.time() + estimate
+    return admission.admit(session_id, estimate)
+
+
+def busy_response():
+    """
+    Response to a session rejected by admission control.
+    """
+    response = flask.make_response("Too many sessions in progress", 503)
+    response.headers.add("Retry-After", str(admission.get_retry_after()))
+    response.headers.add("Access-Control-Allow-Origin", "*")
+    return response
+
+
+def get_claim_fields(parameters: dict) -> dict:
+    """
+    Fields written to a session document when an alignment run claims it.
+    """
+    return {
+        "status": Status.IN_PROGRESS.value,
+        "start": time.time(),
+        "request": parameters,
+        # Overwrite the previous values in case we are restarting a previous
+        # alignment.
+        "end": None,
+        "total": None,
+        "progress": None,
+        "error": None,
+    }
+
+
+def dispatch_alignment(
+    session_id: str, session_doc_ref, options: dict, profile: bool
+) -> str:
+    """
+    Start aligning a claimed session, registered with `start_job`, with the
+    keyword arguments of align_matches in `options`. Returns a message for
+    the client.
+    """
+    # Published before the job starts so that clients subscribing right after
+    # this response never replay events of a previous run.
+    publish(session_id, "started", {"total": len(options["matches"])})
+
+    if broker is not None:
+        # The job is run by whichever worker claims it first, so this process
+        # doesn't track it.
+        broker.enqueue(session_id, {**options, "profile": profile})
+        finish_job(session_id)
+        return "Alignment queued."
+
+    # Start alignment in a separate process to avoid blocking the main
+    # thread and to send a response to the client immediately.
+    pool.apply_async(
+        run_alignment,
+        [session_id, register_job(session_id), profile],
+        {"session_doc_ref": session_doc_ref, **options},
     )
-    dict_spinner.succeed("Dictionary downloaded.")
-assert os.path.exists(dict_name)
+    # align_matches(
+    #     session_id, language, session_doc_ref, matched_files, model, dictionary
+    # )
+    return "Alignment started."
+
+
+def launch_alignment(
+    session_id: str, session_doc_ref, options: dict, profile: bool, method: str
+):
+    """
+    Response to a request that starts aligning a session with
+    `dispatch_alignment`.
+    """
+    message = dispatch_alignment(session_id, session_doc_ref, options, profile)
+    response = flask.jsonify({"message": message})
+    response.headers.add("Access-Control-Allow-Origin", "*")
+    response.headers.add("Access-Control-Allow-Methods", method)
+    return response
+
 
-load_spinner = Halo(text="Loading model and dictionary...").start()
-model, dictionary = get_model_and_dict()
-dictionary["<star>"] = len(dictionary)
-model = model.to(DEVICE)
-load_spinner.succeed("Model and dictionary loaded. Ready to receive requests.")
+def convert_lid_clip(audio_path: str, wav_path: str):
+    """
+    Convert the first LID_SECONDS of an audio file to a 16kHz WAV file.
+    """
+    stream = ffmpeg.input(audio_path)
+    stream = ffmpeg.output(
+        stream, wav_path, acodec="pcm_s16le", ar=16000, t=LID_SECONDS
+    )
+    stream = ffmpeg.overwrite_output(stream)
+    ffmpeg.run(
+        stream,
+        overwrite_output=True,
+        cmd=["ffmpeg", "-loglevel", "error"],  # type: ignore
+    )
 
 
 @app.route("/lid")
@@ -57,48 +221,44 @@ def lid():
         return "Missing session-id parameter", 400
     elif file_name is None:
         return "Missing file-name parameter", 400
-    folder = f"/tmp/sessions/{session_id}"
-    Path(folder).mkdir(parents=True, exist_ok=True)
-    audio_output = f"{folder}/{file_name}"
-    audio_type = file_name.split(".")[-1]
 
-    spinner = Halo(text="Downloading audio file...").start()
-    try:
-        bucket.blob(f"sessions/{session_id}/{file_name}").download_to_filename(
-            audio_output
-        )
-        spinner.succeed("Audio file downloaded.")
-    except Exception as e:
-        spinner.fail(f"Error downloading audio file: {e}")
-        return "Error downloading audio file.", 500
+    with scratch_space(f"lid-{session_id}") as folder:
+        audio_output = f"{folder}/{file_name}"
+        audio_type = file_name.split(".")[-1]
 
-    spinner.text = "Converting audio file to WAV and trimming..."
-    spinner.start()
+        spinner = Halo(text="Downloading audio file...").start()
+        try:
+            with stage("io"):
+                bucket.blob(f"sessions/{session_id}/{file_name}").download_to_filename(
+                    audio_output
+                )
+            spinner.succeed("Audio file downloaded.")
+        except Exception as e:
+            spinner.fail(f"Error downloading audio file: {e}")
+            return "Error downloading audio file.", 500
 
-    try:
-        wav_output = audio_output.replace(f".{audio_type}", "_output.wav")
-        stream = ffmpeg.input(audio_output)
-        stream = ffmpeg.output(stream, wav_output, acodec="pcm_s16le", ar=16000, t=20)
-        stream = ffmpeg.overwrite_output(stream)
-        ffmpeg.run(
-            stream,
-            overwrite_output=True,
-            cmd=["ffmpeg", "-loglevel", "error"],  # type: ignore
-        )
-        spinner.succeed("Audio file converted to WAV and trimmed.")
-    except Exception as e:
-        spinner.fail(f"Error converting audio file: {e}")
-        return "Error converting audio file.", 500
+        spinner.text = "Converting audio file to WAV and trimming..."
+        spinner.start()
 
-    spinner.text = "Identifying language..."
-    spinner.start()
+        try:
+            wav_output = audio_output.replace(f".{audio_type}", "_output.wav")
+            with stage("transcode"):
+                convert_lid_clip(audio_output, wav_output)
+            spinner.succeed("Audio file converted to WAV and trimmed.")
+        except Exception as e:
+            spinner.fail(f"Error converting audio file: {e}")
+            return "Error converting audio file.", 500
 
-    try:
-        language = identify_language(wav_output)
-        spinner.succeed(f"Language identified: {language}")
-    except Exception as e:
-        spinner.fail(f"Error identifying language: {e}")
-        return "Error identifying language.", 500
+        spinner.text = "Identifying language..."
+        spinner.start()
+
+        try:
+            with stage("lid"):
+                language = identify_language(wav_output)
+            spinner.succeed(f"Language identified: {language}")
+        except Exception as e:
+            spinner.fail(f"Error identifying language: {e}")
+            return "Error identifying language.", 500
 
     response = flask.jsonify({"language": language})
     response.headers.add("Access-Control-Allow-Origin", "*")
@@ -106,72 +266,548 @@ def lid():
     return response
 
 
+@app.route("/lid-session")
+def lid_session():
+    session_id = request.args.get("session-id")
+    top_k = request.args.get("top-k", "3")
+
+    if session_id is None:
+        return "Missing session-id parameter", 400
+    elif not top_k.isdigit() or int(top_k) < 1:
+        return "Invalid top-k parameter", 400
+
+    blobs = [
+        blob
+        for blob in bucket.list_blobs(prefix=f"sessions/{session_id}")
+        if blob.name.rsplit(".", 1)[-1].lower() in AUDIO_EXTENSIONS
+    ]
+    if len(blobs) == 0:
+        return "No audio files found in session", 404
+
+    spinner = Halo(text=f"Preparing {len(blobs)} audio files...").start()
+
+    with scratch_space(f"lid-{session_id}") as folder:
+
+        def prepare(index: int) -> str:
+            audio_output = f"{folder}/{index}_{blobs[index].name.split('/')[-1]}"
+            wav_output = f"{folder}/{index}_output.wav"
+            with stage("io"):
+                blobs[index].download_to_filename(audio_output)
+            with stage("transcode"):
+                convert_lid_clip(audio_output, wav_output)
+            return wav_output
+
+        try:
+            # Files are downloaded and converted concurrently, within the
+            # limits of their stages.
+            with Pool(min(len(blobs), STAGE_SLOTS["io"])) as files_pool:
+                wav_outputs = files_pool.map(prepare, range(len(blobs)))
+            spinner.succeed("Audio files prepared.")
+        except Exception as e:
+            spinner.fail(f"Error preparing audio files: {e}")
+            return "Error preparing audio files.", 500
+
+        spinner.text = "Identifying languages..."
+        spinner.start()
+
+        try:
+            with stage("lid"):
+                languages = identify_languages(wav_outputs, int(top_k))
+            spinner.succeed("Languages identified.")
+        except Exception as e:
+            spinner.fail(f"Error identifying languages: {e}")
+            return "Error identifying languages.", 500
+
+    consensus, agreement = get_consensus(languages)
+
+    response = flask.jsonify(
+        {
+            "files": [
+                {
+                    "file_name": blob.name.split("/")[-1],
+                    "languages": [
+                        {"language": language, "score": score}
+                        for language, score in file_languages
+                    ],
+                }
+                for blob, file_languages in zip(blobs, languages)
+            ],
+            "language": consensus,
+            "agreement": agreement,
+        }
+    )
+    response.headers.add("Access-Control-Allow-Origin", "*")
+    response.headers.add("Access-Control-Allow-Methods", "GET")
+    return response
+
+
+def parse_alignment_request(args: Mapping[str, Any]) -> dict[str, Any] | str:
+    """
+    Parse the parameters of an alignment request, from the query string or a
+    JSON object. Returns an error message if they are invalid.
+    """
+    session_id = args.get("session-id")
+    separator = args.get("separator")
+    language = args.get("lang")
+
+    if language is None:
+        return "Missing lang parameter"
+    elif session_id is None:
+        return "Missing session-id parameter"
+    elif separator is None:
+        return "Missing separator parameter"
+
+    tier = args.get("tier") or DEFAULT_TIER
+    if tier not in get_tiers():
+        return f"Unknown tier, expected one of {', '.join(get_tiers())}"
+
+    # Optional JSON object mapping audio file names to the part of the file to
+    # align, e.g. {"genesis.mp3": {"start": 120, "end": 900}}.
+    audio_ranges: dict[str, AudioRange] = {}
+    try:
+        ranges = args.get("ranges", "{}")
+        for file_name, audio_range in (
+            json.loads(ranges) if isinstance(ranges, str) else ranges
+        ).items():
+            start = float(audio_range.get("start") or 0)
+            end = audio_range.get("end")
+            end = None if end is None else float(end)
+            if start < 0 or (end is not None and end <= start):
+                raise ValueError(f"Invalid range for {file_name}")
+            audio_ranges[file_name] = (start, end)
+    except (AttributeError, TypeError, ValueError):
+        return "Invalid ranges parameter"
+
+    return {
+        "session_id": session_id,
+        "language": language,
+        "separator": separator,
+        # Flags are "true" in query strings and may be booleans in JSON.
+        "incremental": str(args.get("incremental")).lower() == "true",
+        "adaptive": str(args.get("adaptive")).lower() == "true",
+        "profile": str(args.get("profile")).lower() == "true",
+        "audio_ranges": audio_ranges,
+        "tier": tier,
+    }
+
+
+def prepare_session(alignment_request: dict[str, Any]):
+    """
+    Find, match, admit and claim the files of a session for a request from
+    `parse_alignment_request`. Returns an error response, or None and the
+    arguments of `dispatch_alignment`.
+    """
+    session_id = alignment_request["session_id"]
+    language = alignment_request["language"]
+    separator = alignment_request["separator"]
+    incremental = alignment_request["incremental"]
+    adaptive = alignment_request["adaptive"]
+    audio_ranges = alignment_request["audio_ranges"]
+    tier = alignment_request["tier"]
+
+    parameters = {
+        "lang": language,
+        "separator": separator,
+        "incremental": incremental,
+        "adaptive": adaptive,
+        "ranges": {
+            name: list(audio_range) for name, audio_range in audio_ranges.items()
+        },
+        "tier": tier,
+    }
+
+    # Identical requests for a session that this process is already aligning
+    # attach to the running job instead of starting a new one.
+    running_parameters = start_job(session_id, parameters)
+    if running_parameters is not None:
+        return attach_response(running_parameters == parameters), None
+
+    try:
+        blobs = bucket.list_blobs(prefix=f"sessions/{session_id}")
+        files: list[File] = []
+        sizes: dict[str, int] = {}
+
+        for blob in blobs:
+            files.append((blob.name.split("/")[-1], blob.public_url, blob.name))
+            sizes[blob.name] = blob.size or 0
+
+        if len(files) == 0:
+            finish_job(session_id)
+            return ("No files found in session", 404), None
+
+        matched_files = match_files(files)
+
+        durations = probe_durations(matched_files, sizes)
+        estimate = estimate_matches(matched_files, sizes, durations, audio_ranges)
+        eta = admit_session(session_id, estimate)
+        if eta is None:
+            finish_job(session_id)
+            return busy_response(), None
+
+        session_doc_ref = db.collection("sessions").document(session_id)
+        claimed, session_doc = claim_session(
+            session_doc_ref,
+            {**get_claim_fields(parameters), "estimated_seconds": estimate, "eta": eta},
+        )
+    except Exception:
+        admission.release(session_id)
+        finish_job(session_id)
+        raise
+
+    if not claimed:
+        admission.release(session_id)
+        finish_job(session_id)
+        # The session is being aligned by another worker.
+        return (
+            attach_response(
+                session_doc is not None and session_doc.get("request") == parameters
+            ),
+            None,
+        )
+
+    previous_timestamps = {}
+    if incremental and session_doc is not None:
+        previous_timestamps = {
+            timestamps["audio_file"]: timestamps
+            for timestamps in session_doc.get("timestamps") or []
+        }
+
+    # Keyword arguments of align_matches that are specific to this request.
+    options = {
+        "language": language,
+        "separator": separator,
+        "matches": matched_files,
+        "previous_timestamps": previous_timestamps,
+        "audio_ranges": audio_ranges,
+        "adaptive": adaptive,
+        "durations": durations,
+        "tier": tier,
+    }
+
+    return None, (session_id, session_doc_ref, options, alignment_request["profile"])
+
+
 @app.route("/")
 def align_session():
+    alignment_request = parse_alignment_request(request.args)
+    if isinstance(alignment_request, str):
+        return alignment_request, 400
+
+    error, prepared = prepare_session(alignment_request)
+    if error is not None:
+        return error
+
+    return launch_alignment(*prepared, "GET")
+
+
+@app.route("/batch", methods=["POST"])
+def submit_batch():
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get("sessions"), list):
+        return "Expected a JSON object with a list of sessions", 400
+
+    alignment_requests = []
+    for index, args in enumerate(body["sessions"]):
+        alignment_request = (
+            parse_alignment_request(args)
+            if isinstance(args, dict)
+            else "Expected an object"
+        )
+        if isinstance(alignment_request, str):
+            return f"Session {index}: {alignment_request}", 400
+        alignment_requests.append(alignment_request)
+
+    session_ids = [
+        alignment_request["session_id"] for alignment_request in alignment_requests
+    ]
+    if len(set(session_ids)) != len(session_ids):
+        return "Duplicate session IDs", 400
+
+    # Sessions of the same language run one after another so that the
+    # normalizer and romanization caches stay warm.
+    alignment_requests.sort(key=lambda alignment_request: alignment_request["language"])
+
+    results = {}
+    jobs = []
+    for alignment_request in alignment_requests:
+        session_id = alignment_request["session_id"]
+        try:
+            error, prepared = prepare_session(alignment_request)
+        except Exception as e:
+            print(traceback.format_exc())
+            error = (str(e), 500)
+        if error is not None:
+            response = flask.make_response(error)
+            results[session_id] = {
+                "status": response.status_code,
+                "message": response.get_data(as_text=True),
+            }
+            continue
+        jobs.append(prepared)
+        results[session_id] = {"status": 200, "message": "Alignment scheduled."}
+
+    batch_id = uuid.uuid4().hex
+    db.collection("batches").document(batch_id).set(
+        {
+            "sessions": [session_id for session_id, _, _, _ in jobs],
+            "start": time.time(),
+        }
+    )
+
+    if broker is not None:
+        # The broker's queue runs the sessions in the order they are enqueued.
+        for job in jobs:
+            dispatch_alignment(*job)
+    elif jobs:
+        for session_id, _, options, _ in jobs:
+            publish(session_id, "started", {"total": len(options["matches"])})
+        pool.apply_async(
+            run_batch,
+            [
+                [
+                    (
+                        session_id,
+                        register_job(session_id),
+                        profile,
+                        session_doc_ref,
+                        options,
+                    )
+                    for session_id, session_doc_ref, options, profile in jobs
+                ]
+            ],
+        )
+
+    response = flask.jsonify({"batch_id": batch_id, "sessions": results})
+    response.headers.add("Access-Control-Allow-Origin", "*")
+    response.headers.add("Access-Control-Allow-Methods", "POST")
+    return response
+
+
+@app.route("/batch")
+def get_batch():
+    batch_id = request.args.get("batch-id")
+
+    if batch_id is None:
+        return "Missing batch-id parameter", 400
+
+    batch_doc = db.collection("batches").document(batch_id).get()
+    if not batch_doc.exists:
+        return "Batch not found", 404
+
+    session_ids = batch_doc.to_dict()["sessions"]
+    session_docs = {
+        snapshot.id: snapshot.to_dict() or {}
+        for snapshot in db.get_all(
+            [db.collection("sessions").document(id) for id in session_ids]
+        )
+    }
+
+    sessions = {}
+    statuses: dict[str, int] = {}
+    for session_id in session_ids:
+        session_doc = session_docs.get(session_id, {})
+        sessions[session_id] = {
+            "status": session_doc.get("status"),
+            "progress": session_doc.get("progress"),
+            "total": session_doc.get("total"),
+            "eta": session_doc.get("eta"),
+        }
+        status = str(session_doc.get("status"))
+        statuses[status] = statuses.get(status, 0) + 1
+
+    etas = [session["eta"] for session in sessions.values() if session["eta"]]
+    response = flask.jsonify(
+        {
+            "batch_id": batch_id,
+            "sessions": sessions,
+            "statuses": statuses,
+            "progress": sum(session["progress"] or 0 for session in sessions.values()),
+            "total": sum(session["total"] or 0 for session in sessions.values()),
+            "done": statuses.get(Status.IN_PROGRESS.value, 0) == 0,
+            "eta": max(etas) if etas else None,
+        }
+    )
+    response.headers.add("Access-Control-Allow-Origin", "*")
+    response.headers.add("Access-Control-Allow-Methods", "GET")
+    return response
+
+
+@app.route("/upload", methods=["POST"])
+def upload_session():
     session_id = request.args.get("session-id")
     separator = request.args.get("separator")
     language = request.args.get("lang")
+    profile = request.args.get("profile") == "true"
+    tier = request.args.get("tier") or DEFAULT_TIER
 
     if language is None:
         return "Missing lang parameter", 400
-    elif session_id is None:
+    elif session_id is None or not is_valid_name(session_id):
         return "Missing session-id parameter", 400
     elif separator is None:
         return "Missing separator parameter", 400
+    elif tier not in get_tiers():
+        return f"Unknown tier, expected one of {', '.join(get_tiers())}", 400
+
+    boundary = request.mimetype_params.get("boundary")
+    if request.mimetype != "multipart/form-data" or not boundary:
+        return "Expected a multipart/form-data body", 400
 
-    blobs = bucket.list_blobs(prefix=f"sessions/{session_id}")
-    files: list[File] = []
+    parameters = {
+        "lang": language,
+        "separator": separator,
+        "upload": True,
+        "tier": tier,
+    }
 
-    for blob in blobs:
-        files.append((blob.name.split("/")[-1], blob.public_url, blob.name))
+    running_parameters = start_job(session_id, parameters)
+    if running_parameters is not None:
+        # An upload can't be attached to, since its files may differ.
+        return "Session already in progress", 400
 
-    if len(files) == 0:
-        return "No files found in session", 404
+    # The audio can't be probed before it is received, so the session is
+    # estimated from the size of the body.
+    estimate = admission.estimate_seconds(
+        (request.content_length or 0) / admission.BYTES_PER_AUDIO_SECOND, 0
+    )
+    eta = admit_session(session_id, estimate)
+    if eta is None:
+        finish_job(session_id)
+        return busy_response()
 
     session_doc_ref = db.collection("sessions").document(session_id)
-    session_doc = session_doc_ref.get()
-    session_doc = None if not session_doc.exists else session_doc.to_dict()
+    try:
+        claimed, _ = claim_session(
+            session_doc_ref,
+            {**get_claim_fields(parameters), "estimated_seconds": estimate, "eta": eta},
+        )
+    except Exception:
+        admission.release(session_id)
+        finish_job(session_id)
+        raise
 
-    if (
-        session_doc is not None
-        and session_doc.get("status") == Status.IN_PROGRESS.value
-    ):
+    if not claimed:
+        admission.release(session_id)
+        finish_job(session_id)
         return "Session already in progress", 400
 
-    matched_files = match_files(files)
-
-    session_doc_ref.set(
-        {
-            "status": Status.IN_PROGRESS.value,
-            "start": time.time(),
-            # Overwrite the previous values in case we are restarting a
-            # previous alignment.
-            "end": None,
-            "total": None,
-            "progress": None,
-            "error": None,
-        },
-        merge=True,
+    # The body is read as it arrives, so the audio is decoded by the time the
+    # upload completes instead of being stored and downloaded again first.
+    folder = (
+        f"{UPLOAD_DIR}/{session_id}"
+        if broker is not None
+        else f"{UPLOAD_DIR}/{os.getpid()}-{session_id}"
     )
+    try:
+        match = receive_upload(request.stream, boundary, folder)
+    except Exception as e:
+        admission.release(session_id)
+        finish_job(session_id)
+        shutil.rmtree(folder, ignore_errors=True)
+        session_doc_ref.set(
+            {"status": Status.FAILED.value, "error": str(e), "end": time.time()},
+            merge=True,
+        )
+        if isinstance(e, UploadError):
+            return str(e), 400
+        raise
 
-    # Start alignment in a separate process to avoid blocking the main
-    # thread and to send a response to the client immediately.
-    pool.apply_async(
-        align_matches,
-        [
-            session_id,
-            language,
-            separator,
-            session_doc_ref,
-            matched_files,
-            model,
-            dictionary,
-        ],
+    options = {
+        "language": language,
+        "separator": separator,
+        "matches": [match],
+        "tier": tier,
+    }
+
+    return launch_alignment(session_id, session_doc_ref, options, profile, "POST")
+
+
+@app.route("/events")
+def session_events():
+    session_id = request.args.get("session-id")
+
+    if session_id is None:
+        return "Missing session-id parameter", 400
+
+    response = flask.Response(
+        flask.stream_with_context(stream(session_id)),
+        mimetype="text/event-stream",
     )
-    # align_matches(
-    #     session_id, language, session_doc_ref, matched_files, model, dictionary
-    # )
-    response = flask.jsonify({"message": "Alignment started."})
+    response.headers.add("Cache-Control", "no-cache")
+    response.headers.add("X-Accel-Buffering", "no")
+    response.headers.add("Access-Control-Allow-Origin", "*")
+    response.headers.add("Access-Control-Allow-Methods", "GET")
+    return response
+
+
+@app.route("/metrics")
+def get_metrics():
+    response = flask.jsonify(metrics.snapshot())
+    response.headers.add("Access-Control-Allow-Origin", "*")
+    response.headers.add("Access-Control-Allow-Methods", "GET")
+    return response
+
+
+@app.route("/profile")
+def get_profile():
+    session_id = request.args.get("session-id")
+    file_name = request.args.get("file")
+
+    if session_id is None:
+        return "Missing session-id parameter", 400
+    elif not is_valid_name(session_id):
+        return "Invalid session-id parameter", 400
+
+    if file_name is None:
+        files = list_profile_files(session_id)
+        if len(files) == 0:
+            return "No profile found for session", 404
+        response = flask.jsonify({"files": files})
+    elif not is_valid_name(file_name):
+        return "Invalid file parameter", 400
+    else:
+        response = flask.send_from_directory(
+            get_profile_folder(session_id), file_name, as_attachment=True
+        )
+
+    response.headers.add("Access-Control-Allow-Origin", "*")
+    response.headers.add("Access-Control-Allow-Methods", "GET")
+    return response
+
+
+@app.route("/cancel")
+def cancel_session():
+    session_id = request.args.get("session-id")
+
+    if session_id is None:
+        return "Missing session-id parameter", 400
+    elif not is_valid_name(session_id):
+        # The ID names the upload folder that is removed below.
+        return "Invalid session-id parameter", 400
+
+    # A running job marks its session as cancelled itself once it stops.
+    cancelled = cancel_job(session_id)
+
+    if not cancelled and broker is not None:
+        status = broker.cancel(session_id)
+        cancelled = status is not None
+        if status == "queued":
+            db.collection("sessions").document(session_id).set(
+                {
+                    "status": Status.CANCELLED.value,
+                    "error": "Cancelled by user.",
+                    "end": time.time(),
+                },
+                merge=True,
+            )
+            publish(session_id, "cancelled", {"error": "Cancelled by user."})
+            # Queued jobs never run, so nothing else removes their uploads.
+            shutil.rmtree(f"{UPLOAD_DIR}/{session_id}", ignore_errors=True)
+
+    if not cancelled:
+        return "No running alignment for session", 404
+
+    response = flask.jsonify({"message": "Alignment cancelled."})
     response.headers.add("Access-Control-Allow-Origin", "*")
     response.headers.add("Access-Control-Allow-Methods", "GET")
     return response
@@ -0,0 +1,193 @@
+"""
+Memory budget of alignment jobs. The peak memory of aligning a file is
+estimated from its audio duration and transcript length, and files only start
+aligning while their estimates fit in the budget together. Peaks measured from
+the resident memory of the process refine the estimates over time.
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+import metrics
+from alignment import COARSE_TO_FINE_TOKENS
+from learned_factor import LearnedFactor
+from mms.align_utils import COARSE_FACTOR
+from scheduler import wait_for_room
+
+# File the learned scale of the estimates is kept in across restarts.
+STATE_PATH = os.environ.get("MEMORY_STATE", "/tmp/memory.json")
+
+# Bytes that the files aligned at once by this process may use together. 0
+# uses MEMORY_BUDGET_FRACTION of the memory available when it is first needed.
+MEMORY_BUDGET_BYTES = int(os.environ.get("MEMORY_BUDGET_BYTES", 0))
+
+# Fraction of the available memory used as the budget by default.
+MEMORY_BUDGET_FRACTION = 0.75
+
+# Bytes every file needs regardless of its size: model activations of an
+# emission window, decoding buffers and the like.
+BASE_BYTES = 512 * 1024 * 1024
+
+# Bytes per second of audio: the waveform, its emission matrix and copies of
+# them made while aligning.
+BYTES_PER_AUDIO_SECOND = 256 * 1024
+
+# Emission frames per second of audio (20ms stride).
+FRAMES_PER_SECOND = 50
+
+# Bytes per cell of the forced alignment trellis (frames by CTC states).
+BYTES_PER_PATH_CELL = 1
+
+# Weight of a new measurement in the moving average of the scale.
+SMOOTHING = 0.2
+
+# Seconds between samples of the resident memory of the process.
+SAMPLE_INTERVAL = 0.2
+
+
+class _Reservation:
+    def __init__(self, size: int):
+        self.size = size
+        # Largest share of the memory used by jobs attributed to this one.
+        self.peak = 0
+
+
+_condition = threading.Condition()
+_reservations: set[_Reservation] = set()
+_budget: int | None = None
+_scale = LearnedFactor(STATE_PATH, "scale", "memory.scale", 1.0, SMOOTHING)
+_sampler: threading.Thread | None = None
+# Resident memory of the process the last time no file was being aligned.
+_baseline = 0
+
+
+def _get_resident_bytes() -> int:
+    """
+    Resident memory of the process, or 0 where it can't be read.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _get_budget() -> int:
+    global _budget
+    if _budget is None:
+        _budget = MEMORY_BUDGET_BYTES or int(
+            os.sysconf("SC_AVPHYS_PAGES")
+            * os.sysconf("SC_PAGE_SIZE")
+            * MEMORY_BUDGET_FRACTION
+        )
+        metrics.set_value("memory.budget_bytes", _budget)
+    return _budget
+
+
+def get_model_bytes(audio_seconds: float, characters: int) -> int:
+    """
+    Peak bytes of aligning audio and text according to the unscaled model.
+    """
+    frames = audio_seconds * FRAMES_PER_SECOND
+    # Every token and the blanks around it are states of the CTC trellis.
+    states = 2 * characters + 1
+    if 0 < COARSE_TO_FINE_TOKENS < characters:
+        # Long transcripts are aligned at a lower frame rate first.
+        frames /= COARSE_FACTOR
+    return int(
+        BASE_BYTES
+        + audio_seconds * BYTES_PER_AUDIO_SECOND
+        + frames * states * BYTES_PER_PATH_CELL
+    )
+
+
+def estimate_bytes(audio_seconds: float, characters: int) -> int:
+    """
+    Estimated peak bytes of aligning audio and text.
+    """
+    with _condition:
+        return int(get_model_bytes(audio_seconds, characters) * _scale.get())
+
+
+def _sample():
+    """
+    Attribute the memory used above the baseline to the files being aligned,
+    in proportion to their estimates.
+    """
+    global _baseline
+    while True:
+        resident = _get_resident_bytes()
+        with _condition:
+            reserved = sum(reservation.size for reservation in _reservations)
+            if not _reservations:
+                _baseline = resident
+            else:
+                used = max(0, resident - _baseline)
+                for reservation in _reservations:
+                    reservation.peak = max(
+                        reservation.peak, used * reservation.size // reserved
+                    )
+        time.sleep(SAMPLE_INTERVAL)
+
+
+def _reserve(size: int) -> _Reservation:
+    """
+    Reserve bytes of the budget, waiting for them to be released by other
+    files if it is used up.
+    """
+    global _sampler, _baseline
+
+    with _condition:
+        if _sampler is None:
+            _baseline = _get_resident_bytes()
+            _sampler = threading.Thread(target=_sample, daemon=True)
+            _sampler.start()
+
+        wait_for_room(
+            _condition,
+            lambda: sum(reservation.size for reservation in _reservations),
+            size,
+            _get_budget(),
+            "memory",
+        )
+        reservation = _Reservation(size)
+        _reservations.add(reservation)
+        metrics.set_value(
+            "memory.reserved_bytes",
+            sum(reservation.size for reservation in _reservations),
+        )
+
+    return reservation
+
+
+def _release(reservation: _Reservation):
+    with _condition:
+        _reservations.discard(reservation)
+        metrics.set_value(
+            "memory.reserved_bytes",
+            sum(reservation.size for reservation in _reservations),
+        )
+        _condition.notify_all()
+
+
+@contextmanager
+def memory_budget(audio_seconds: float, characters: int) -> Iterator[None]:
+    """
+    Align a file within the memory budget, waiting until its estimated peak
+    fits, and refine the estimates with its measured peak.
+    """
+    model_bytes = get_model_bytes(audio_seconds, characters)
+    reservation = _reserve(estimate_bytes(audio_seconds, characters))
+    try:
+        yield
+    finally:
+        _release(reservation)
+
+    metrics.increment("memory.estimated_bytes", reservation.size)
+    metrics.increment("memory.peak_bytes", reservation.peak)
+    # Files too short to be sampled say nothing about the model.
+    if reservation.peak > 0:
+        _scale.observe(reservation.peak / model_bytes)
@@ -0,0 +1,33 @@
+"""
+In-process counters and gauges exposed through the /metrics endpoint.
+"""
+
+import threading
+from typing import Any
+
+_lock = threading.Lock()
+_metrics: dict[str, Any] = {}
+
+
+def increment(name: str, value: float = 1):
+    """
+    Add a value to a counter, starting at 0.
+    """
+    with _lock:
+        _metrics[name] = _metrics.get(name, 0) + value
+
+
+def set_value(name: str, value: Any):
+    """
+    Set a gauge to a value.
+    """
+    with _lock:
+        _metrics[name] = value
+
+
+def snapshot() -> dict[str, Any]:
+    """
+    Return a copy of every metric.
+    """
+    with _lock:
+        return dict(_metrics)
@@ -1,8 +1,16 @@
+import atexit
+import json
 import math
+import os
 import re
 import subprocess
 import tempfile
+import threading
+import time
+from collections import OrderedDict
 from dataclasses import dataclass
+from multiprocessing.dummy import Pool
+from pathlib import Path
 from typing import Any, List, TypedDict, Union
 
 import sox
@@ -11,12 +19,54 @@ import torchaudio
 import torchaudio.functional as F
 from torchaudio.models import wav2vec2_model
 
-from constants import dict_name, model_name
+import metrics
+from cancellation import check_cancelled, get_token
+from profiling import torch_section
+from scheduler import get_inference_threads
 
 SAMPLING_FREQ = 16000
 EMISSION_INTERVAL = 30
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+# Maximum number of romanized words kept per language, and an optional folder
+# to persist them to across restarts.
+UROMAN_CACHE_SIZE = int(os.environ.get("UROMAN_CACHE_SIZE", 200000))
+UROMAN_CACHE_DIR = os.environ.get("UROMAN_CACHE_DIR")
+# Minimum seconds between writes of a language's cache to UROMAN_CACHE_DIR.
+# Caches with unsaved words are also written when the process exits.
+UROMAN_CACHE_SAVE_INTERVAL = float(os.environ.get("UROMAN_CACHE_SAVE_INTERVAL", 60))
+
+# Recordings longer than this many seconds keep their emissions in a
+# memory-mapped file instead of RAM when running on CPU. 0 disables it.
+EMISSION_MMAP_SECONDS = float(os.environ.get("EMISSION_MMAP_SECONDS", 0))
+EMISSION_MMAP_DIR = os.environ.get("EMISSION_MMAP_DIR", tempfile.gettempdir())
+
+# Number of frames averaged into one by the coarse pass of a coarse-to-fine
+# alignment, and the minimum length in seconds of the parts of the audio that
+# the fine pass aligns independently.
+COARSE_FACTOR = 4
+FINE_CHUNK_SECONDS = 60
+
+# Compile the model with torch.compile, running it on windows padded to
+# multiples of WINDOW_BUCKET_SECONDS.
+COMPILE_MODEL = os.environ.get("COMPILE_MODEL") == "true"
+WINDOW_BUCKET_SECONDS = EMISSION_INTERVAL / 4
+
+# Kernel size and stride of the convolutions of the model's feature extractor.
+CONV_LAYERS = [(10, 5), (3, 2), (3, 2), (3, 2), (3, 2), (2, 2), (2, 2)]
+
+# Graphs compiled by `compile_model` so far, one per window length and
+# precision of every compiled model. They share the compile cache of the
+# model's forward code.
+compiled_graphs = 0
+
+uroman_caches: dict[str, "OrderedDict[str, str]"] = {}
+uroman_cache_lock = threading.Lock()
+# Languages whose cache has words that aren't persisted yet, and when each
+# cache was last persisted.
+uroman_unsaved: set[str] = set()
+uroman_saved_at: dict[str, float] = {}
+
 
 class MMSSegment(TypedDict):
     begin: float
@@ -64,12 +114,16 @@ def normalize_uroman(text: str):
     return text.strip()
 
 
-def get_uroman_tokens(norm_transcripts: List[str], iso: Union[str, None] = None):
+def run_uroman(lines: List[str], iso: Union[str, None] = None):
+    """
+    Romanize lines with uroman and split the output into space-separated
+    characters.
+    """
     normalized_file = tempfile.NamedTemporaryFile()
     uroman_file = tempfile.NamedTemporaryFile()
 
     with open(normalized_file.name, "w", encoding="utf-8") as f:
-        for t in norm_transcripts:
+        for t in lines:
             f.write(t + "\n")
 
     cmd = ["uroman", "-i", normalized_file.name, "-o", uroman_file.name]
@@ -85,18 +139,132 @@ def get_uroman_tokens(norm_transcripts: List[str], iso: Union[str, None] = None)
             line = " ".join(line.strip())
             line = re.sub(r"\s+", " ", line).strip()
             outtexts.append(line)
-    assert len(outtexts) == len(norm_transcripts)
+    assert len(outtexts) == len(lines)
     uromans: List[str] = []
     for ot in outtexts:
         uromans.append(normalize_uroman(ot))
     return uromans
 
 
+def load_uroman_cache(iso: str) -> "OrderedDict[str, str]":
+    """
+    Word cache of a language, loaded from UROMAN_CACHE_DIR on first use.
+    Must be called with `uroman_cache_lock` held.
+    """
+    if iso in uroman_caches:
+        return uroman_caches[iso]
+
+    cache: OrderedDict[str, str] = OrderedDict()
+    if UROMAN_CACHE_DIR:
+        try:
+            with open(f"{UROMAN_CACHE_DIR}/{iso}.json", encoding="utf-8") as f:
+                cache.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+
+    uroman_caches[iso] = cache
+    return cache
+
+
+def save_uroman_cache(iso: str, words: dict[str, str]):
+    """
+    Write a snapshot of the word cache of a language to UROMAN_CACHE_DIR.
+    The temporary file is unique, so processes sharing the folder don't write
+    over each other's.
+    """
+    assert UROMAN_CACHE_DIR
+    Path(UROMAN_CACHE_DIR).mkdir(parents=True, exist_ok=True)
+    fd, temporary_path = tempfile.mkstemp(
+        dir=UROMAN_CACHE_DIR, prefix=f"{iso}.", suffix=".tmp"
+    )
+    try:
+        with open(fd, "w", encoding="utf-8") as f:
+            json.dump(words, f, ensure_ascii=False)
+        os.replace(temporary_path, f"{UROMAN_CACHE_DIR}/{iso}.json")
+    except BaseException:
+        Path(temporary_path).unlink(missing_ok=True)
+        raise
+
+
+def persist_uroman_caches(force: bool = False):
+    """
+    Persist the caches with unsaved words to UROMAN_CACHE_DIR, if set, unless
+    they were persisted less than UROMAN_CACHE_SAVE_INTERVAL seconds ago and
+    `force` isn't set. Files are written outside of `uroman_cache_lock`.
+    """
+    if not UROMAN_CACHE_DIR:
+        return
+
+    now = time.monotonic()
+    with uroman_cache_lock:
+        due = [
+            iso
+            for iso in uroman_unsaved
+            if force
+            or now - uroman_saved_at.get(iso, -math.inf) >= UROMAN_CACHE_SAVE_INTERVAL
+        ]
+        snapshots = {iso: dict(uroman_caches[iso]) for iso in due}
+        for iso in due:
+            uroman_unsaved.discard(iso)
+            uroman_saved_at[iso] = now
+
+    for iso, words in snapshots.items():
+        try:
+            save_uroman_cache(iso, words)
+        except OSError as e:
+            print(f"Could not save the romanization cache of {iso or 'default'}: {e}")
+
+
+atexit.register(persist_uroman_caches, force=True)
+
+
+def get_uroman_tokens(norm_transcripts: List[str], iso: Union[str, None] = None):
+    """
+    Romanize normalized lines word by word. Romanized words are cached per
+    language, so only words that weren't seen before are sent to uroman.
+
+    Romanizing words separately gives the same tokens as romanizing whole
+    lines because the characters of every word are space-separated and
+    repeated spaces are collapsed either way.
+    """
+    cache_iso = iso or ""
+    words = {word: "" for t in norm_transcripts for word in t.split()}
+
+    with uroman_cache_lock:
+        cache = load_uroman_cache(cache_iso)
+        for word in words:
+            if word in cache:
+                cache.move_to_end(word)
+                words[word] = cache[word]
+        unseen = [word for word in words if word not in cache]
+
+    if unseen:
+        for word, uroman in zip(unseen, run_uroman(unseen, iso)):
+            words[word] = uroman
+
+        with uroman_cache_lock:
+            cache = load_uroman_cache(cache_iso)
+            for word in unseen:
+                cache[word] = words[word]
+            while len(cache) > UROMAN_CACHE_SIZE:
+                cache.popitem(last=False)
+            uroman_unsaved.add(cache_iso)
+
+        persist_uroman_caches()
+
+    uromans: List[str] = []
+    for t in norm_transcripts:
+        uromans.append(" ".join(words[word] for word in t.split() if words[word]))
+    return uromans
+
+
 @dataclass
 class Segment:
     label: str
     start: int
     end: int
+    # Mean probability of the label over the frames of the segment.
+    score: float = 0.0
 
     def __repr__(self):
         return f"{self.label}: [{self.start:5d}, {self.end:5d})"
@@ -106,50 +274,139 @@ class Segment:
         return self.end - self.start
 
 
-def merge_repeats(path: List[Any], idx_to_token_map: dict[int, str]):
+def merge_repeats(
+    path: List[Any],
+    idx_to_token_map: dict[int, str],
+    scores: Union[List[float], None] = None,
+):
     i1, i2 = 0, 0
     segments: List[Segment] = []
     while i1 < len(path):
         while i2 < len(path) and path[i1] == path[i2]:
             i2 += 1
-        segments.append(Segment(idx_to_token_map[path[i1]], i1, i2 - 1))
+        score = sum(scores[i1:i2]) / (i2 - i1) if scores else 0.0
+        segments.append(Segment(idx_to_token_map[path[i1]], i1, i2 - 1, score))
         i1 = i2
     return segments
 
 
+def get_confidence(span: List[Segment]):
+    """
+    Mean probability of the non-blank frames of a span, or 1 if it has none.
+    """
+    frames = 0
+    total = 0.0
+    for seg in span:
+        if seg.label == "<blank>":
+            continue
+        frames += seg.end - seg.start + 1
+        total += seg.score * (seg.end - seg.start + 1)
+    return total / frames if frames else 1.0
+
+
 def time_to_frame(time: float):
     stride_msec = 20
     frames_per_sec = 1000 / stride_msec
     return int(time * frames_per_sec)
 
 
-def get_spans(tokens: List[str], segments: List[Segment]):
-    ltr_idx = 0
-    tokens_idx = 0
-    intervals = []
-    start, end = (0, 0)
+@dataclass
+class Encoding:
+    """
+    Target token IDs of lines, from `Tokenizer.encode`.
+    """
+
+    targets: torch.Tensor
+    # Index of the first target of each line, followed by the number of
+    # targets.
+    offsets: List[int]
+    # Characters missing from the dictionary by line index. They are left
+    # out of the targets.
+    oov: dict[int, List[str]]
+
+
+class Tokenizer:
+    """
+    Maps lines of space-separated romanized characters to target token IDs.
+    Built once per dictionary with `get_tokenizer`.
+    """
+
+    def __init__(self, dictionary: dict[str, int]):
+        self.ids = dict(dictionary)
+        self.labels = [""] * (max(dictionary.values()) + 1)
+        for label, idx in dictionary.items():
+            self.labels[idx] = label
+
+    def encode(self, lines: List[str]) -> Encoding:
+        chars = [[c for c in line.split(" ") if c] for line in lines]
+        ids = torch.tensor(
+            [self.ids.get(c, -1) for line in chars for c in line], dtype=torch.int64
+        )
+        line_indices = torch.repeat_interleave(
+            torch.arange(len(lines)), torch.tensor([len(line) for line in chars])
+        )
+        known = ids >= 0
+
+        counts = torch.bincount(line_indices[known], minlength=len(lines))
+        offsets = [0] + torch.cumsum(counts, 0).tolist()
+
+        oov: dict[int, List[str]] = {}
+        unknown = (~known).nonzero().flatten().tolist()
+        if unknown:
+            flat_chars = [c for line in chars for c in line]
+            for position in unknown:
+                line_oov = oov.setdefault(int(line_indices[position]), [])
+                if flat_chars[position] not in line_oov:
+                    line_oov.append(flat_chars[position])
+
+        return Encoding(ids[known].to(torch.int32), offsets, oov)
+
+
+_tokenizers: dict[int, tuple[dict[str, int], Tokenizer]] = {}
+
+
+def get_tokenizer(dictionary: dict[str, int]) -> Tokenizer:
+    """
+    Tokenizer of a dictionary, built on first use. The dictionary must not
+    change afterwards.
+    """
+    cached = _tokenizers.get(id(dictionary))
+    if cached is None or cached[0] is not dictionary:
+        cached = (dictionary, Tokenizer(dictionary))
+        _tokenizers[id(dictionary)] = cached
+    return cached[1]
+
+
+def report_oov(oov: dict[int, List[str]]):
+    """
+    Log and count characters missing from the dictionary.
+    """
+    for line, chars in oov.items():
+        print(f"Line {line} has characters missing from the dictionary: {chars}")
+        metrics.increment("tokenizer.oov_characters", len(chars))
+    if oov:
+        metrics.increment("tokenizer.oov_lines", len(oov))
+
+
+def get_spans(offsets: List[int], segments: List[Segment]):
+    """
+    Segments of each line, with the silence around them, given the offsets of
+    the lines' tokens in the targets from `Tokenizer.encode`.
+    """
     sil = "<blank>"
-    for seg_idx, seg in enumerate(segments):
-        if tokens_idx == len(tokens):
-            assert seg_idx == len(segments) - 1
-            assert seg.label == "<blank>"
-            continue
-        cur_token = tokens[tokens_idx].split(" ")
-        ltr = cur_token[ltr_idx]
-        if seg.label == "<blank>":
-            continue
-        assert seg.label == ltr
-        if (ltr_idx) == 0:
-            start = seg_idx
-        if ltr_idx == len(cur_token) - 1:
-            ltr_idx = 0
-            tokens_idx += 1
-            intervals.append((start, seg_idx))
-            while tokens_idx < len(tokens) and len(tokens[tokens_idx]) == 0:
-                intervals.append((seg_idx, seg_idx))
-                tokens_idx += 1
+    # The n-th non-blank segment is the n-th target token.
+    tokens = [idx for idx, seg in enumerate(segments) if seg.label != sil]
+    assert len(tokens) == offsets[-1]
+
+    intervals = []
+    for first, last in zip(offsets, offsets[1:]):
+        if last > first:
+            intervals.append((tokens[first], tokens[last - 1]))
         else:
-            ltr_idx += 1
+            # Lines without tokens are anchored to the end of the previous one.
+            seg_idx = tokens[first - 1] if first > 0 else 0
+            intervals.append((seg_idx, seg_idx))
+
     spans: List[List[Segment]] = []
     for idx, (start, end) in enumerate(intervals):
         span = segments[start : end + 1]
@@ -175,23 +432,242 @@ def get_spans(tokens: List[str], segments: List[Segment]):
     return spans
 
 
-def generate_emissions(model: Any, audio_file: str):
-    waveform, _ = torchaudio.load(audio_file)  # waveform: channels X T
-    waveform = waveform.to(DEVICE)
-    total_duration = sox.file_info.duration(audio_file)
+@dataclass
+class EmissionConfig:
+    """
+    Settings of emission generation that trade speed for accuracy.
+    """
+
+    # Length in seconds of the windows the audio is split into.
+    interval: float = EMISSION_INTERVAL
+    # Audio added on each side of a window as context, as a fraction of the
+    # interval.
+    context: float = 0.1
+    # Run the model in float16 on GPU or bfloat16 on CPU.
+    half_precision: bool = False
+
+
+DEFAULT_EMISSION_CONFIG = EmissionConfig()
+# Used for the first pass of an adaptive alignment.
+FAST_EMISSION_CONFIG = EmissionConfig(context=0.05, half_precision=True)
+# Used to re-process low-confidence regions of an adaptive alignment.
+ACCURATE_EMISSION_CONFIG = EmissionConfig(context=0.25)
+
+
+class EmissionWriter:
+    """
+    Collects the emissions of consecutive windows in one buffer of `frames`
+    rows, allocated on the first write, with an extra zero column for the
+    <star> token. Windows are normalized with log_softmax as they are written,
+    so no other full-size copy of the emissions is ever made.
+    """
+
+    def __init__(self, frames: int, memory_mapped: bool = False):
+        self.capacity = frames
+        self.memory_mapped = memory_mapped
+        self.frames = 0
+        self.buffer: Union[torch.Tensor, None] = None
+
+    def _allocate(self, columns: int) -> torch.Tensor:
+        if not self.memory_mapped:
+            return torch.empty(self.capacity, columns, device=DEVICE)
+
+        Path(EMISSION_MMAP_DIR).mkdir(parents=True, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=EMISSION_MMAP_DIR, suffix=".emissions")
+        try:
+            os.ftruncate(fd, self.capacity * columns * 4)
+            buffer = torch.from_file(
+                path, shared=True, size=self.capacity * columns, dtype=torch.float32
+            )
+        finally:
+            # The mapping stays valid until the buffer is freed.
+            os.close(fd)
+            os.remove(path)
+        return buffer.view(self.capacity, columns)
+
+    def write(self, window: torch.Tensor):
+        """
+        Append the logits of a window, of shape frames x vocabulary.
+        """
+        if self.buffer is None:
+            self.buffer = self._allocate(window.size(1) + 1)
+            self.buffer[:, -1] = 0
+
+        frames = min(window.size(0), self.capacity - self.frames)
+        self.buffer[self.frames : self.frames + frames, :-1] = torch.log_softmax(
+            window[:frames].float(), dim=-1
+        )
+        self.frames += frames
+
+    def get(self) -> torch.Tensor:
+        """
+        The emissions written so far, without copying them.
+        """
+        assert self.buffer is not None, "No emissions were written"
+        return self.buffer[: self.frames]
+
+
+def get_frame_count(samples: int) -> int:
+    """
+    Number of emission frames the model outputs for a number of samples.
+    """
+    for kernel, stride in CONV_LAYERS:
+        samples = max(0, (samples - kernel) // stride + 1)
+    return samples
+
+
+class CompiledModel:
+    """
+    Runs a model compiled with torch.compile on windows zero-padded to a few
+    fixed lengths, so that it is compiled once per length instead of for
+    every window shape. Windows longer than the longest length run on the
+    model as is.
+    """
+
+    def __init__(self, model: Any, max_seconds: float):
+        self.model = model
+        self.compiled = torch.compile(model, dynamic=False)
+        self.buckets = [
+            int(WINDOW_BUCKET_SECONDS * k * SAMPLING_FREQ)
+            for k in range(1, math.ceil(max_seconds / WINDOW_BUCKET_SECONDS) + 1)
+        ]
+
+    def __call__(self, waveform: torch.Tensor):
+        samples = waveform.size(1)
+        bucket = next((bucket for bucket in self.buckets if bucket >= samples), None)
+        if bucket is None:
+            return self.model(waveform)
+
+        padded = torch.nn.functional.pad(waveform, (0, bucket - samples))
+        # The encoder masks the padding given the length of the window, and
+        # its frames are dropped, so that emissions don't depend on the bucket.
+        outputs, lengths = self.compiled(
+            padded, torch.tensor([samples], device=waveform.device)
+        )
+        return outputs[:, : get_frame_count(samples)], lengths
+
+    def warm_up(self, half_precision: bool) -> dict[str, float]:
+        """
+        Compile every bucket, with or without half precision. Returns the
+        mean seconds per window of the first (compiling) run, of later
+        compiled runs and of the model as is.
+        """
+        timings = {"first": 0.0, "compiled": 0.0, "eager": 0.0}
+
+        with torch.inference_mode(), torch.autocast(
+            device_type=DEVICE.type,
+            dtype=torch.float16 if DEVICE.type == "cuda" else torch.bfloat16,
+            enabled=half_precision,
+        ):
+            for bucket in self.buckets:
+                waveform = torch.zeros(1, bucket, device=DEVICE)
+                # Windows are compiled with lengths, as they are run.
+                lengths = torch.tensor([bucket], device=DEVICE)
+                for name, run in [
+                    ("first", self.compiled),
+                    ("compiled", self.compiled),
+                    ("eager", self.model),
+                ]:
+                    start = time.perf_counter()
+                    run(waveform, lengths)
+                    if DEVICE.type == "cuda":
+                        torch.cuda.synchronize()
+                    timings[name] += (time.perf_counter() - start) / len(self.buckets)
+
+        return timings
+
+
+def compile_model(model: Any) -> Any:
+    """
+    Compile a model for the windows of every emission config and warm it up,
+    recording the latencies in the metrics. Returns the model as is if it
+    can't be compiled.
+    """
+    global compiled_graphs
+
+    configs = [DEFAULT_EMISSION_CONFIG, FAST_EMISSION_CONFIG, ACCURATE_EMISSION_CONFIG]
+    compiled = CompiledModel(
+        model,
+        max(config.interval * (1 + 2 * config.context) for config in configs),
+    )
+    precisions = sorted({config.half_precision for config in configs})
+
+    # Past the cache size limit, dynamo silently runs new shapes uncompiled, so
+    # it must hold every bucket in every precision.
+    compiled_graphs += len(compiled.buckets) * len(precisions)
+    torch._dynamo.config.cache_size_limit = max(
+        torch._dynamo.config.cache_size_limit, compiled_graphs
+    )
+
+    try:
+        for half_precision in precisions:
+            timings = compiled.warm_up(half_precision)
+            precision = "half" if half_precision else "full"
+            for name, seconds in timings.items():
+                metrics.set_value(
+                    f"inference.warm_up.{precision}.{name}_window_seconds", seconds
+                )
+    except Exception as e:
+        print(f"Could not compile the model, running it as is: {e}")
+        return model
+
+    # Every bucket is compiled by now, so recompiles while serving are
+    # unexpected and logged with their cause.
+    torch._logging.set_logs(recompiles=True)
+
+    return compiled
 
-    assert total_duration, "Could not get duration of audio file"
 
+def generate_emissions(
+    model: Any,
+    audio_file: str,
+    start: float = 0,
+    end: Union[float, None] = None,
+    config: EmissionConfig = DEFAULT_EMISSION_CONFIG,
+):
+    """
+    Generate emissions for the audio between `start` and `end` seconds, or
+    until the end of the file if `end` is None. Only that range is read. The
+    emissions include a zero column for the <star> token.
+    """
     audio_sf = sox.file_info.sample_rate(audio_file)
     assert audio_sf == SAMPLING_FREQ
 
-    emissions_arr = []
-    with torch.inference_mode():
-        i: float = 0
+    frame_offset = int(start * SAMPLING_FREQ)
+    num_frames = -1 if end is None else int(end * SAMPLING_FREQ) - frame_offset
+    waveform, _ = torchaudio.load(
+        audio_file, frame_offset=frame_offset, num_frames=num_frames
+    )  # waveform: channels X T
+    waveform = waveform.to(DEVICE)
+    total_duration = waveform.size(1) / SAMPLING_FREQ
+
+    assert total_duration, "Could not get duration of audio file"
+
+    # Every window keeps the frames of its interval, so the number of frames
+    # is known before running the model.
+    frames = 0
+    i: float = 0
+    while i < total_duration:
+        frames += time_to_frame(i + config.interval) - time_to_frame(i)
+        i += config.interval
+
+    writer = EmissionWriter(
+        frames,
+        memory_mapped=EMISSION_MMAP_SECONDS > 0
+        and total_duration > EMISSION_MMAP_SECONDS
+        and DEVICE.type == "cpu",
+    )
+    with torch.inference_mode(), torch.autocast(
+        device_type=DEVICE.type,
+        dtype=torch.float16 if DEVICE.type == "cuda" else torch.bfloat16,
+        enabled=config.half_precision,
+    ):
+        i = 0
         while i < total_duration:
-            segment_start_time, segment_end_time = (i, i + EMISSION_INTERVAL)
+            check_cancelled()
+            segment_start_time, segment_end_time = (i, i + config.interval)
 
-            context = EMISSION_INTERVAL * 0.1
+            context = config.interval * config.context
             input_start_time = max(segment_start_time - context, 0)
             input_end_time = min(segment_end_time + context, total_duration)
             waveform_split = waveform[
@@ -201,7 +677,12 @@ def generate_emissions(model: Any, audio_file: str):
                 ),
             ]
 
+            window_start = time.perf_counter()
             model_outs, _ = model(waveform_split)
+            metrics.increment("inference.windows")
+            metrics.increment(
+                "inference.window_seconds", time.perf_counter() - window_start
+            )
             emissions_ = model_outs[0]
             emission_start_frame = time_to_frame(segment_start_time)
             emission_end_frame = time_to_frame(segment_end_time)
@@ -210,11 +691,10 @@ def generate_emissions(model: Any, audio_file: str):
             emissions_ = emissions_[
                 emission_start_frame - offset : emission_end_frame - offset, :
             ]
-            emissions_arr.append(emissions_)
-            i += EMISSION_INTERVAL
+            writer.write(emissions_)
+            i += config.interval
 
-    emissions = torch.cat(emissions_arr, dim=0).squeeze()
-    emissions = torch.log_softmax(emissions, dim=-1)
+    emissions = writer.get()
 
     stride = float(waveform.size(1) * 1000 / emissions.size(0) / SAMPLING_FREQ)
 
@@ -226,79 +706,232 @@ def get_alignments(
     tokens: List[str],
     model: Any,
     dictionary: dict[str, int],
+    start: float = 0,
+    end: Union[float, None] = None,
+    config: EmissionConfig = DEFAULT_EMISSION_CONFIG,
 ):
+    """
+    Align lines of tokens to audio. Returns the spans of each line, the stride
+    of the emissions and the characters missing from the dictionary by line.
+    """
+    tokenizer = get_tokenizer(dictionary)
+    encoding = tokenizer.encode(tokens)
+    report_oov(encoding.oov)
 
     # Generate emissions
-    emissions, stride = generate_emissions(model, audio_file)
-    T, _ = emissions.size()
+    with torch_section("generate_emissions"):
+        emissions, stride = generate_emissions(model, audio_file, start, end, config)
+    spans = align_emissions(emissions, encoding, tokenizer)
 
-    emissions = torch.cat([emissions, torch.zeros(T, 1).to(DEVICE)], dim=1)
+    return spans, stride, encoding.oov
 
+
+def align_emissions(
+    emissions: torch.Tensor,
+    encoding: Encoding,
+    tokenizer: Tokenizer,
+):
+    """
+    Align encoded lines to emissions from `generate_emissions`, returning the
+    spans of each line.
+    """
     # Force Alignment
-    if tokens:
-        token_indices = [
-            dictionary[c] for c in " ".join(tokens).split(" ") if c in dictionary
-        ]
-    else:
-        print(f"Empty transcript for audio file {audio_file}.")
-        token_indices = []
+    if encoding.targets.numel() == 0:
+        print("Empty transcript.")
 
-    blank = dictionary["<blank>"]
+    blank = tokenizer.ids["<blank>"]
 
-    targets = torch.tensor(token_indices, dtype=torch.int32).to(DEVICE)
+    targets = encoding.targets.to(DEVICE)
 
     input_lengths = torch.tensor(emissions.shape[0]).unsqueeze(-1)
     target_lengths = torch.tensor(targets.shape[0]).unsqueeze(-1)
 
-    path, _ = F.forced_align(
-        emissions.unsqueeze(0),
-        targets.unsqueeze(0),
-        input_lengths,
-        target_lengths,
-        blank=blank,
-    )
+    with torch_section("forced_align"):
+        path, scores = F.forced_align(
+            emissions.unsqueeze(0),
+            targets.unsqueeze(0),
+            input_lengths,
+            target_lengths,
+            blank=blank,
+        )
 
     path = path.squeeze().to("cpu").tolist()
-    idx_to_token_map = {v: k for k, v in dictionary.items()}
-    segments = merge_repeats(path, idx_to_token_map)
-
-    return segments, stride
-
-
-def get_model_and_dict():
-    state_dict = torch.load(model_name, map_location="cpu", weights_only=True)
-
-    model = wav2vec2_model(
-        extractor_mode="layer_norm",
-        extractor_conv_layer_config=[
-            (512, 10, 5),
-            (512, 3, 2),
-            (512, 3, 2),
-            (512, 3, 2),
-            (512, 3, 2),
-            (512, 2, 2),
-            (512, 2, 2),
-        ],
-        extractor_conv_bias=True,
-        encoder_embed_dim=1024,
-        encoder_projection_dropout=0.0,
-        encoder_pos_conv_kernel=128,
-        encoder_pos_conv_groups=16,
-        encoder_num_layers=24,
-        encoder_num_heads=16,
-        encoder_attention_dropout=0.0,
-        encoder_ff_interm_features=4096,
-        encoder_ff_interm_dropout=0.1,
-        encoder_dropout=0.0,
-        encoder_layer_norm_first=True,
-        encoder_layer_drop=0.1,
-        aux_num_out=31,
-    )
+    scores = scores.squeeze().exp().to("cpu").tolist()
+    segments = merge_repeats(path, tokenizer.labels, scores)
+
+    return get_spans(encoding.offsets, segments)
+
+
+class AudioTooShort(Exception):
+    """
+    Raised when emissions have fewer frames than the CTC alignment of a
+    transcript needs.
+    """
+
+
+def check_enough_frames(emissions: torch.Tensor, encoding: Encoding):
+    """
+    Raise AudioTooShort unless the emissions have a frame for every target and
+    for the blank that separates each repeated target from the previous one.
+    """
+    targets = encoding.targets
+    repeats = int((targets[1:] == targets[:-1]).sum()) if targets.numel() else 0
+    needed = targets.numel() + repeats
+    if emissions.size(0) < needed:
+        raise AudioTooShort(
+            f"{emissions.size(0)} frames for {needed} aligned positions"
+        )
+
+
+def downsample_emissions(emissions: torch.Tensor, factor: int) -> torch.Tensor:
+    """
+    Average the probabilities of every `factor` consecutive frames.
+    """
+    T, C = emissions.size()
+    frames = math.ceil(T / factor)
+    padding = frames * factor - T
+    if padding:
+        emissions = torch.cat([emissions, emissions[-1:].expand(padding, C)])
+    return emissions.view(frames, factor, C).logsumexp(1) - math.log(factor)
+
+
+def collapse_tokens(tokens: List[str], factor: int) -> List[str]:
+    """
+    Keep every `factor`th token of each line, so that lines can be located on
+    emissions downsampled by the same factor.
+    """
+    collapsed = []
+    for line in tokens:
+        if line == "<star>" or len(line) == 0:
+            collapsed.append(line)
+        else:
+            collapsed.append(" ".join(line.split(" ")[::factor]))
+    return collapsed
+
+
+def get_line_boundaries(
+    emissions: torch.Tensor,
+    tokens: List[str],
+    dictionary: dict[str, int],
+    factor: int = COARSE_FACTOR,
+) -> List[int]:
+    """
+    Approximate first emission frame of each line, found by aligning a
+    collapsed version of the lines to downsampled emissions.
+    """
+    tokenizer = get_tokenizer(dictionary)
+    downsampled = downsample_emissions(emissions, factor)
+    encoding = tokenizer.encode(collapse_tokens(tokens, factor))
+    check_enough_frames(downsampled, encoding)
+    spans = align_emissions(downsampled, encoding, tokenizer)
+    return [span[0].start * factor for span in spans]
+
+
+def align_coarse_to_fine(
+    emissions: torch.Tensor,
+    tokens: List[str],
+    dictionary: dict[str, int],
+    stride: float,
+) -> List[List[Segment]]:
+    """
+    Align lines of tokens, the first being <star>, in two passes: line
+    boundaries are located on downsampled emissions first, then groups of
+    lines of at least FINE_CHUNK_SECONDS are aligned at full resolution
+    independently and in parallel. Returns the spans of each line, like
+    `align_emissions`.
+    """
+    boundaries = get_line_boundaries(emissions, tokens, dictionary)
+
+    chunk_frames = int(FINE_CHUNK_SECONDS * 1000 / stride)
+    # Lines [first, last) aligned over frames [start, end) for each chunk.
+    chunks: List[tuple[int, int, int, int]] = []
+    first = 0
+    for index in range(1, len(tokens) + 1):
+        end = boundaries[index] if index < len(tokens) else emissions.size(0)
+        start = boundaries[first] if first > 0 else 0
+        if index == len(tokens) or end - start >= chunk_frames:
+            chunks.append((first, index, start, end))
+            first = index
+
+    tokenizer = get_tokenizer(dictionary)
+    # Chunks run on other threads, which don't have the job's token.
+    cancel_token = get_token()
+
+    def align_chunk(chunk: tuple[int, int, int, int]) -> List[List[Segment]]:
+        first, last, start, end = chunk
+        if cancel_token is not None:
+            cancel_token.check()
+        # Audio of the previous chunk's last line that falls into this chunk
+        # is absorbed by a leading <star>.
+        chunk_tokens = (["<star>"] if first > 0 else []) + tokens[first:last]
+        chunk_encoding = tokenizer.encode(chunk_tokens)
+        check_enough_frames(emissions[start:end], chunk_encoding)
+        spans = align_emissions(emissions[start:end], chunk_encoding, tokenizer)
+        if first > 0:
+            spans = spans[1:]
+        return [
+            [
+                Segment(
+                    segment.label,
+                    segment.start + start,
+                    segment.end + start,
+                    segment.score,
+                )
+                for segment in span
+            ]
+            for span in spans
+        ]
+
+    with Pool(min(len(chunks), get_inference_threads())) as pool:
+        return [span for spans in pool.map(align_chunk, chunks) for span in spans]
+
+
+def get_coarse_to_fine_spans(
+    audio_file: str,
+    tokens: List[str],
+    model: Any,
+    dictionary: dict[str, int],
+    start: float = 0,
+    end: Union[float, None] = None,
+    config: EmissionConfig = DEFAULT_EMISSION_CONFIG,
+):
+    """
+    Like `get_alignments`, but aligning with `align_coarse_to_fine`. Falls
+    back on a single pass if the coarse boundaries leave a part of the audio
+    too short for its lines.
+    """
+    tokenizer = get_tokenizer(dictionary)
+    encoding = tokenizer.encode(tokens)
+    report_oov(encoding.oov)
+
+    with torch_section("generate_emissions"):
+        emissions, stride = generate_emissions(model, audio_file, start, end, config)
+
+    try:
+        with torch_section("coarse_to_fine_align"):
+            spans = align_coarse_to_fine(emissions, tokens, dictionary, stride)
+    except AudioTooShort as e:
+        print(f"Coarse-to-fine alignment failed, aligning in one pass: {e}")
+        spans = align_emissions(emissions, encoding, tokenizer)
+
+    return spans, stride, encoding.oov
+
+
+def get_model(checkpoint: str, architecture: dict[str, Any], quantized: bool = False):
+    state_dict = torch.load(checkpoint, map_location="cpu", weights_only=True)
+
+    model = wav2vec2_model(**architecture)
     model.load_state_dict(state_dict)
     model.eval()
 
-    dictionary = {}
-    with open(dict_name, encoding="utf-8") as f:
-        dictionary = {l.strip(): i for i, l in enumerate(f.readlines())}
+    if quantized:
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+
+    return model
+
 
-    return model, dictionary
+def get_dictionary(path: str) -> dict[str, int]:
+    with open(path, encoding="utf-8") as f:
+        return {l.strip(): i for i, l in enumerate(f.readlines())}
@@ -0,0 +1,109 @@
+"""
+Registry of the acoustic models that sessions can be aligned with. Each tier
+names a CTC checkpoint, its architecture and its dictionary. Tiers are loaded
+by `alignment.load_model_and_dict` the first time they are used.
+"""
+
+import json
+import os
+from dataclasses import dataclass, field
+from typing import Any
+
+import torch
+
+from constants import dict_name, dict_url, model_name, model_url, model_version
+
+# Keyword arguments of torchaudio's wav2vec2_model for the MMS alignment model.
+MMS_ARCHITECTURE: dict[str, Any] = {
+    "extractor_mode": "layer_norm",
+    "extractor_conv_layer_config": [
+        (512, 10, 5),
+        (512, 3, 2),
+        (512, 3, 2),
+        (512, 3, 2),
+        (512, 3, 2),
+        (512, 2, 2),
+        (512, 2, 2),
+    ],
+    "extractor_conv_bias": True,
+    "encoder_embed_dim": 1024,
+    "encoder_projection_dropout": 0.0,
+    "encoder_pos_conv_kernel": 128,
+    "encoder_pos_conv_groups": 16,
+    "encoder_num_layers": 24,
+    "encoder_num_heads": 16,
+    "encoder_attention_dropout": 0.0,
+    "encoder_ff_interm_features": 4096,
+    "encoder_ff_interm_dropout": 0.1,
+    "encoder_dropout": 0.0,
+    "encoder_layer_norm_first": True,
+    "encoder_layer_drop": 0.1,
+    "aux_num_out": 31,
+}
+
+# JSON file describing additional tiers, e.g. smaller checkpoints, by name:
+# {"small": {"checkpoint": "small.pt", "checkpoint_url": "...",
+# "version": "small-v1", "architecture": {"encoder_num_layers": 12, ...}}}.
+# Architectures default to MMS_ARCHITECTURE and dictionaries to the MMS one.
+REGISTRY_PATH = os.environ.get("MODEL_REGISTRY", "")
+
+# Tier used by requests that don't pick one, and loaded at startup.
+DEFAULT_TIER = os.environ.get("MODEL_TIER", "standard")
+
+
+@dataclass(frozen=True)
+class ModelSpec:
+    """
+    A checkpoint, where to download it from and how to load it.
+    """
+
+    checkpoint: str
+    checkpoint_url: str
+    # Identifies the checkpoint and dictionary in cached alignments.
+    version: str
+    dictionary: str = dict_name
+    dictionary_url: str = dict_url
+    architecture: dict[str, Any] = field(default_factory=lambda: MMS_ARCHITECTURE)
+    # Linear layers are quantized to int8 after loading. Faster on CPU, at the
+    # cost of some accuracy.
+    quantized: bool = False
+
+
+MODELS: dict[str, ModelSpec] = {
+    "standard": ModelSpec(model_name, model_url, model_version),
+    "fast": ModelSpec(model_name, model_url, f"{model_version}-int8", quantized=True),
+}
+
+if REGISTRY_PATH:
+    with open(REGISTRY_PATH, encoding="utf-8") as f:
+        for tier, entry in json.load(f).items():
+            MODELS[tier] = ModelSpec(
+                **{
+                    **entry,
+                    "architecture": {
+                        **MMS_ARCHITECTURE,
+                        **entry.get("architecture", {}),
+                    },
+                }
+            )
+
+
+def get_tiers() -> list[str]:
+    """
+    Names of the tiers available on this machine. Quantized tiers only run on
+    CPU.
+    """
+    return [
+        tier
+        for tier, spec in MODELS.items()
+        if not spec.quantized or not torch.cuda.is_available()
+    ]
+
+
+def get_spec(tier: str) -> ModelSpec:
+    """
+    Description of a tier. Raises a ValueError for unknown tiers.
+    """
+    if tier not in get_tiers():
+        raise ValueError(f"Unknown model tier: {tier}")
+    return MODELS[tier]
@@ -0,0 +1,106 @@
+"""
+Opt-in profiling of single alignment jobs. Profiling is scoped to the thread
+that runs a job, so jobs that aren't profiled pay nothing for it.
+"""
+
+import cProfile
+import os
+import re
+import threading
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Iterator
+
+import torch
+
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "/tmp/profiles")
+
+_local = threading.local()
+
+
+def get_profile_folder(session_id: str) -> str:
+    """
+    Folder holding the trace files of a session.
+    """
+    return f"{PROFILE_DIR}/{session_id}"
+
+
+@contextmanager
+def profile_job(session_id: str, enabled: bool) -> Iterator[None]:
+    """
+    Profile the Python code run by the current thread into `job.pstats`, and
+    enable `torch_section` traces, if `enabled`.
+    """
+    if not enabled:
+        yield
+        return
+
+    folder = get_profile_folder(session_id)
+    Path(folder).mkdir(parents=True, exist_ok=True)
+    for path in Path(folder).iterdir():
+        path.unlink()
+
+    _local.folder = folder
+    _local.sections = 0
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(f"{folder}/job.pstats")
+        _local.folder = None
+
+
+def is_profiling() -> bool:
+    """
+    Whether the current thread is running a profiled job.
+    """
+    return getattr(_local, "folder", None) is not None
+
+
+def torch_section(name: str):
+    """
+    Trace a section with the torch profiler into a Chrome trace if the current
+    thread is running a profiled job. Returns a no-op context otherwise, and
+    inside another section, which the torch profiler can't be nested in.
+    """
+    if not is_profiling() or getattr(_local, "tracing", False):
+        return nullcontext()
+
+    return _trace_section(name)
+
+
+@contextmanager
+def _trace_section(name: str) -> Iterator[None]:
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+    _local.sections += 1
+    path = f"{_local.folder}/{_local.sections:03d}_{name}.json"
+
+    _local.tracing = True
+    try:
+        with torch.profiler.profile(activities=activities, record_shapes=True) as prof:
+            yield
+    finally:
+        _local.tracing = False
+    prof.export_chrome_trace(path)
+
+
+def list_profile_files(session_id: str) -> list[str]:
+    """
+    Names of the trace files of a session.
+    """
+    folder = Path(get_profile_folder(session_id))
+    if not folder.is_dir():
+        return []
+    return sorted(path.name for path in folder.iterdir())
+
+
+def is_valid_name(name: str) -> bool:
+    """
+    Whether a session ID or file name is safe to use in a profile path.
+    """
+    return re.fullmatch(r"[\w.-]+", name) is not None and name not in {".", ".."}
@@ -0,0 +1,275 @@
+"""
+Golden-output regression harness for the alignment pipeline.
+
+Fixtures are audio/text pairs with the same name in a folder, e.g.
+`genesis_1.mp3` and `genesis_1.txt`. `record` aligns them with the default
+settings and stores the sections as `genesis_1.golden.json`. `check` aligns
+them with the given settings and compares the sections against the golden
+ones, so performance modes can be validated offline before deployment:
+
+    python regression.py record --lang eng --separator lineBreak
+    python regression.py check --adaptive --tolerance 0.2
+    python regression.py check --tier fast --tolerance 0.2
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, TypedDict
+
+from halo import Halo
+
+from alignment import (
+    convert_to_wav,
+    load_model_and_dict,
+    read_lines,
+    refine_sections,
+    timestamp_lines,
+)
+from mms.align_utils import FAST_EMISSION_CONFIG, EmissionConfig
+from models import DEFAULT_TIER
+from timestamp_types import Section
+
+AUDIO_EXTENSIONS = {".wav", ".mp3"}
+TEXT_EXTENSIONS = {".txt", ".usfm"}
+
+
+class Golden(TypedDict):
+    """
+    Reference output of a fixture.
+    """
+
+    language: str
+    separator: str
+    seconds: float
+    sections: list[Section]
+
+
+class Deviation(TypedDict):
+    """
+    Deviation of the begin or end times of a fixture from its golden output.
+    """
+
+    mean: float
+    median: float
+    p95: float
+    max: float
+
+
+def find_fixtures(folder: str) -> list[tuple[Path, Path]]:
+    """
+    Audio and text files in a folder matched by name.
+    """
+    files = sorted(Path(folder).iterdir())
+    audio = {path.stem: path for path in files if path.suffix in AUDIO_EXTENSIONS}
+    text = {path.stem: path for path in files if path.suffix in TEXT_EXTENSIONS}
+    return [(audio[name], text[name]) for name in sorted(audio) if name in text]
+
+
+def run_pipeline(
+    audio_path: Path,
+    text_path: Path,
+    language: str,
+    separator: str,
+    model: Any,
+    dictionary: Any,
+    options: argparse.Namespace,
+) -> tuple[list[Section], float]:
+    """
+    Align a fixture with the settings in `options`. Returns the sections and
+    the number of seconds it took, excluding transcoding.
+    """
+    spinner = Halo()
+    config = EmissionConfig(
+        interval=options.interval,
+        context=options.context,
+        half_precision=options.half_precision,
+    )
+
+    with tempfile.TemporaryDirectory() as folder:
+        wav_path = f"{folder}/audio.wav"
+        convert_to_wav(str(audio_path), wav_path)
+
+        start = time.perf_counter()
+        sections = timestamp_lines(
+            wav_path,
+            read_lines(str(text_path), separator),
+            language,
+            model,
+            dictionary,
+            spinner,
+            emission_config=FAST_EMISSION_CONFIG if options.adaptive else config,
+            coarse_to_fine=options.coarse_to_fine,
+        )
+        if options.adaptive:
+            sections = refine_sections(
+                wav_path, sections, language, model, dictionary, spinner
+            )
+        seconds = time.perf_counter() - start
+
+    spinner.stop()
+    return sections, seconds
+
+
+def get_deviation(values: list[float]) -> Deviation | None:
+    """
+    Summary statistics of absolute deviations, or None if there are none.
+    """
+    if len(values) == 0:
+        return None
+
+    ordered = sorted(values)
+    return {
+        "mean": statistics.fmean(ordered),
+        "median": statistics.median(ordered),
+        "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        "max": ordered[-1],
+    }
+
+
+def compare(golden: list[Section], sections: list[Section]) -> dict[str, Any]:
+    """
+    Compare sections against golden sections of the same text.
+    """
+    if [section["text"] for section in golden] != [
+        section["text"] for section in sections
+    ]:
+        raise ValueError("The text of the sections differs from the golden output.")
+
+    begin = [abs(a["begin"] - b["begin"]) for a, b in zip(golden, sections)]
+    end = [abs(a["end"] - b["end"]) for a, b in zip(golden, sections)]
+
+    return {
+        "sections": len(sections),
+        "begin": get_deviation(begin),
+        "end": get_deviation(end),
+    }
+
+
+def record(options: argparse.Namespace):
+    model, dictionary = load_model_and_dict(options.tier)
+
+    for audio_path, text_path in find_fixtures(options.fixtures):
+        sections, seconds = run_pipeline(
+            audio_path,
+            text_path,
+            options.lang,
+            options.separator,
+            model,
+            dictionary,
+            options,
+        )
+        golden: Golden = {
+            "language": options.lang,
+            "separator": options.separator,
+            "seconds": seconds,
+            "sections": sections,
+        }
+        golden_path = audio_path.with_suffix(".golden.json")
+        with open(golden_path, "w", encoding="utf-8") as f:
+            json.dump(golden, f, ensure_ascii=False, indent=2)
+        print(f"Recorded {golden_path} ({len(sections)} sections, {seconds:.1f}s).")
+
+
+def check(options: argparse.Namespace) -> bool:
+    model, dictionary = load_model_and_dict(options.tier)
+    report = {}
+    passed = True
+
+    for audio_path, text_path in find_fixtures(options.fixtures):
+        golden_path = audio_path.with_suffix(".golden.json")
+        if not golden_path.exists():
+            print(f"Skipping {audio_path.name}: no golden output.")
+            continue
+
+        with open(golden_path, encoding="utf-8") as f:
+            golden: Golden = json.load(f)
+
+        sections, seconds = run_pipeline(
+            audio_path,
+            text_path,
+            golden["language"],
+            golden["separator"],
+            model,
+            dictionary,
+            options,
+        )
+        result = compare(golden["sections"], sections)
+        result["seconds"] = seconds
+        result["speedup"] = golden["seconds"] / seconds if seconds else None
+        report[audio_path.stem] = result
+
+        if result["begin"] is None or result["end"] is None:
+            # Nothing to compare, which neither passes nor fails.
+            result["passed"] = None
+            print(f"EMPTY {audio_path.stem}: no sections to compare.")
+            continue
+
+        result["passed"] = (
+            result["begin"]["max"] <= options.tolerance
+            and result["end"]["max"] <= options.tolerance
+        )
+        passed = passed and result["passed"]
+
+        print(
+            f"{'PASS' if result['passed'] else 'FAIL'} {audio_path.stem}: "
+            f"begin mean {result['begin']['mean']:.3f}s "
+            f"p95 {result['begin']['p95']:.3f}s max {result['begin']['max']:.3f}s, "
+            f"end mean {result['end']['mean']:.3f}s "
+            f"p95 {result['end']['p95']:.3f}s max {result['end']['max']:.3f}s, "
+            f"{seconds:.1f}s ({result['speedup'] or 0:.2f}x)"
+        )
+
+    if options.report:
+        with open(options.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("command", choices=["record", "check"])
+    parser.add_argument(
+        "--fixtures",
+        default=os.environ.get("REGRESSION_FIXTURES", "regression_fixtures"),
+        help="Folder with the audio/text fixtures and their golden outputs.",
+    )
+    parser.add_argument("--lang", default="eng", help="Language when recording.")
+    parser.add_argument(
+        "--separator", default="lineBreak", help="Separator when recording."
+    )
+    parser.add_argument("--interval", type=float, default=30)
+    parser.add_argument("--context", type=float, default=0.1)
+    parser.add_argument("--half-precision", action="store_true")
+    parser.add_argument("--adaptive", action="store_true")
+    parser.add_argument(
+        "--coarse-to-fine",
+        action=argparse.BooleanOptionalAction,
+        help="Force coarse-to-fine alignment on or off (default by length).",
+    )
+    parser.add_argument(
+        "--tier", default=DEFAULT_TIER, help="Model tier to align with."
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="Maximum begin/end deviation in seconds for a fixture to pass.",
+    )
+    parser.add_argument("--report", help="Write the comparison as JSON to a file.")
+    options = parser.parse_args()
+
+    if options.command == "record":
+        record(options)
+    elif not check(options):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
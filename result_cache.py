@@ -0,0 +1,123 @@
+"""
+Bounded on-disk cache of alignment results for identical audio/text pairs.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+import metrics
+from timestamp_types import Section
+
+CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", "/tmp/result_cache")
+CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", 1024**3))
+
+# Bump whenever the format or content of the cached sections changes.
+CACHE_FORMAT = 3
+
+_lock = threading.Lock()
+
+
+def hash_file(path: str) -> str:
+    """
+    SHA-256 of the contents of a file.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def make_key(
+    audio_hash: str,
+    text_path: str,
+    language: str,
+    separator: str,
+    audio_range: tuple[float, float],
+    mode: str,
+    model_version: str,
+) -> str:
+    """
+    Cache key of an alignment request, given the hash of the audio file, the
+    aligned range of it, the alignment mode and the version of the model. The
+    text extension is part of the key because .txt and .usfm files with the
+    same content are split differently.
+    """
+    parts = [
+        audio_hash,
+        f"{audio_range[0]}-{audio_range[1]}",
+        hash_file(text_path),
+        text_path.split(".")[-1],
+        language,
+        separator,
+        mode,
+        model_version,
+        str(CACHE_FORMAT),
+    ]
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+def get(key: str) -> list[Section] | None:
+    """
+    Return the cached sections for a key, or None on a miss.
+    """
+    path = Path(CACHE_DIR) / f"{key}.json"
+
+    try:
+        with open(path, encoding="utf-8") as f:
+            sections = json.load(f)
+        # Reading an entry marks it as recently used for eviction.
+        os.utime(path)
+    except (OSError, ValueError):
+        metrics.increment("result_cache.misses")
+        return None
+
+    metrics.increment("result_cache.hits")
+    return sections
+
+
+def put(key: str, sections: list[Section]):
+    """
+    Store the sections for a key, evicting least recently used entries when
+    the cache grows beyond CACHE_MAX_BYTES.
+    """
+    folder = Path(CACHE_DIR)
+    folder.mkdir(parents=True, exist_ok=True)
+    path = folder / f"{key}.json"
+    temp_path = folder / f"{key}.{threading.get_ident()}.tmp"
+
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(sections, f, ensure_ascii=False)
+    os.replace(temp_path, path)
+    metrics.increment("result_cache.writes")
+
+    with _lock:
+        evict()
+
+
+def evict():
+    """
+    Delete least recently used entries until the cache fits CACHE_MAX_BYTES.
+    """
+    entries = []
+    for path in Path(CACHE_DIR).glob("*.json"):
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total_bytes = sum(size for _, size, _ in entries)
+    metrics.set_value("result_cache.bytes", total_bytes)
+
+    for _, size, path in sorted(entries):
+        if total_bytes <= CACHE_MAX_BYTES:
+            break
+        path.unlink(missing_ok=True)
+        total_bytes -= size
+        metrics.increment("result_cache.evictions")
+
+    metrics.set_value("result_cache.bytes", total_bytes)
@@ -0,0 +1,119 @@
+"""
+Stage-aware limits on concurrent work. Every alignment stage takes a slot from
+its own pool, so concurrent sessions can't oversubscribe the CPU with
+transcoding, romanization and model forward passes at the same time.
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+import torch
+
+import metrics
+from cancellation import check_cancelled
+
+CPU_COUNT = os.cpu_count() or 1
+
+# Number of concurrent slots of each stage.
+STAGE_SLOTS = {
+    # Downloads and uploads, which mostly wait on the network.
+    "io": int(os.environ.get("IO_SLOTS", 8)),
+    # ffmpeg processes.
+    "transcode": int(os.environ.get("TRANSCODE_SLOTS", max(1, CPU_COUNT // 4))),
+    # Text normalization and uroman processes.
+    "text": int(os.environ.get("TEXT_SLOTS", max(1, CPU_COUNT // 4))),
+    # Emission generation and forced alignment.
+    "inference": int(os.environ.get("INFERENCE_SLOTS", 1)),
+    # Language identification, kept apart from inference so that short
+    # interactive requests don't wait behind whole alignments.
+    "lid": int(os.environ.get("LID_SLOTS", 1)),
+}
+
+_semaphores = {
+    name: threading.BoundedSemaphore(slots) for name, slots in STAGE_SLOTS.items()
+}
+_local = threading.local()
+
+
+def get_inference_threads() -> int:
+    """
+    Number of torch intra-op threads for each inference slot: the cores left
+    over by the transcoding and text slots, split between inference slots.
+    """
+    free_cores = CPU_COUNT - STAGE_SLOTS["transcode"] - STAGE_SLOTS["text"]
+    return max(1, free_cores // STAGE_SLOTS["inference"])
+
+
+def configure_torch_threads():
+    """
+    Partition the cores between stages by limiting the torch thread pools.
+    """
+    torch.set_num_threads(get_inference_threads())
+    try:
+        # Can only be set before any inter-op parallel work has started.
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+
+
+def get_wait_seconds() -> float:
+    """
+    Total seconds the current thread has waited for stage slots and other
+    shared resources.
+    """
+    return getattr(_local, "wait_seconds", 0.0)
+
+
+def add_wait_seconds(seconds: float):
+    """
+    Count seconds the current thread has waited for a shared resource.
+    """
+    _local.wait_seconds = get_wait_seconds() + seconds
+
+
+def wait_for_room(
+    condition: threading.Condition,
+    get_reserved: Callable[[], int],
+    size: int,
+    limit: int,
+    name: str,
+):
+    """
+    Wait on `condition`, which the caller holds, until `size` more units fit
+    in `limit` next to the `get_reserved()` ones. A size larger than the limit
+    fits once nothing else is reserved. A limit of 0 disables it. The wait is
+    counted in the `{name}.wait_seconds` metric.
+    """
+    start = time.perf_counter()
+
+    while limit and get_reserved() > 0 and get_reserved() + size > limit:
+        # Waiting jobs can still be cancelled.
+        check_cancelled()
+        condition.wait(timeout=1)
+
+    wait_seconds = time.perf_counter() - start
+    add_wait_seconds(wait_seconds)
+    metrics.increment(f"{name}.wait_seconds", wait_seconds)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """
+    Run a block of work in a slot of a stage, waiting for one to be free.
+    """
+    semaphore = _semaphores[name]
+
+    start = time.perf_counter()
+    semaphore.acquire()
+    wait_seconds = time.perf_counter() - start
+    add_wait_seconds(wait_seconds)
+    metrics.increment(f"scheduler.{name}.wait_seconds", wait_seconds)
+    metrics.increment(f"scheduler.{name}.active")
+    try:
+        yield
+    finally:
+        metrics.increment(f"scheduler.{name}.active", -1)
+        semaphore.release()
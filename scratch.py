@@ -0,0 +1,133 @@
+"""
+Scratch space for the temporary files of jobs. Every job gets its own folder,
+on tmpfs when it fits, which is removed when the job ends however it ends.
+Folders count towards a global quota, and jobs wait for space when it is used
+up.
+"""
+
+import os
+import re
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+import metrics
+from scheduler import wait_for_room
+
+# Folder for scratch space on disk. Anything else in it is removed at startup.
+SCRATCH_DIR = os.environ.get("SCRATCH_DIR", "/tmp/sessions")
+
+# Memory-backed folder used for scratch space while it has room. Empty
+# disables it.
+TMPFS_DIR = os.environ.get("SCRATCH_TMPFS_DIR", "/dev/shm")
+
+# Maximum fraction of the free space of TMPFS_DIR given to scratch space.
+TMPFS_FRACTION = 0.5
+
+# Bytes of scratch space all jobs of this process may reserve together. 0
+# disables the quota.
+SCRATCH_MAX_BYTES = int(os.environ.get("SCRATCH_MAX_BYTES", 0))
+
+# Bytes reserved for a job that can't estimate its needs.
+DEFAULT_SCRATCH_BYTES = 256 * 1024 * 1024
+
+_condition = threading.Condition()
+# Reserved bytes by scratch root.
+_reserved: dict[str, int] = {}
+
+
+def _get_roots() -> list[str]:
+    roots = []
+    if TMPFS_DIR and os.path.isdir(TMPFS_DIR) and os.access(TMPFS_DIR, os.W_OK):
+        roots.append(f"{TMPFS_DIR}/timestamper")
+    roots.append(SCRATCH_DIR)
+    return roots
+
+
+def _choose_root(size: int) -> str:
+    """
+    The tmpfs root if `size` more bytes fit in its share, else the disk one.
+    """
+    roots = _get_roots()
+    if len(roots) > 1:
+        free = shutil.disk_usage(TMPFS_DIR).free
+        if _reserved.get(roots[0], 0) + size <= free * TMPFS_FRACTION:
+            return roots[0]
+    return roots[-1]
+
+
+def _reserve(size: int) -> str:
+    """
+    Reserve bytes of scratch space, waiting for them to be released by other
+    jobs if the quota is used up. Returns the root to use.
+    """
+    with _condition:
+        wait_for_room(
+            _condition,
+            lambda: sum(_reserved.values()),
+            size,
+            SCRATCH_MAX_BYTES,
+            "scratch",
+        )
+        root = _choose_root(size)
+        _reserved[root] = _reserved.get(root, 0) + size
+        metrics.set_value("scratch.reserved_bytes", sum(_reserved.values()))
+
+    return root
+
+
+def _release(root: str, size: int):
+    with _condition:
+        _reserved[root] -= size
+        metrics.set_value("scratch.reserved_bytes", sum(_reserved.values()))
+        _condition.notify_all()
+
+
+@contextmanager
+def scratch_space(name: str, size: int = DEFAULT_SCRATCH_BYTES) -> Iterator[str]:
+    """
+    Create a folder for a job expected to write up to `size` bytes, and
+    remove it with its contents once the job is done.
+    """
+    root = _reserve(size)
+    try:
+        Path(root).mkdir(parents=True, exist_ok=True)
+        # The process ID lets `clean_orphans` tell folders of running
+        # processes apart.
+        name = re.sub(r"[^\w.-]", "_", name)
+        folder = tempfile.mkdtemp(prefix=f"{os.getpid()}-{name}-", dir=root)
+        try:
+            yield folder
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+    finally:
+        _release(root, size)
+
+
+def _is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def clean_orphans(roots: list[str] | None = None):
+    """
+    Remove the scratch folders of processes that are no longer running, e.g.
+    after a crash, and any other folder in the scratch roots, or in `roots`.
+    """
+    for root in roots or _get_roots():
+        if not os.path.isdir(root):
+            continue
+        for path in Path(root).iterdir():
+            pid, _, _ = path.name.partition("-")
+            if pid.isdigit() and int(pid) != os.getpid() and _is_running(int(pid)):
+                continue
+            if path.is_dir():
+                shutil.rmtree(path, ignore_errors=True)
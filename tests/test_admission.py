@@ -0,0 +1,75 @@
+import json
+import time
+from pathlib import Path
+
+import pytest
+
+import admission
+from learned_factor import LearnedFactor
+
+
+@pytest.fixture(autouse=True)
+def state(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> Path:
+    path = tmp_path / "admission.json"
+    monkeypatch.setattr(
+        admission,
+        "_real_time_factor",
+        LearnedFactor(str(path), "real_time_factor", "test.factor", 0.5, 0.5),
+    )
+    monkeypatch.setattr(admission, "_backlog", {})
+    monkeypatch.setattr(admission, "TEXT_SECONDS_PER_CHARACTER", 0.01)
+    return path
+
+
+def test_estimate_uses_real_time_factor():
+    # 100s of audio and 1000 characters are 110s of work.
+    assert admission.estimate_seconds(100, 1000) == pytest.approx(55)
+
+
+def test_observe_learns_and_persists_factor(state: Path):
+    admission.observe(100, 0, 150)
+
+    # Half way from 0.5 to the measured 1.5.
+    assert admission.estimate_seconds(100, 0) == pytest.approx(100)
+    assert json.loads(state.read_text()) == {"real_time_factor": pytest.approx(1.0)}
+
+
+def test_factor_is_loaded_from_state(state: Path):
+    state.write_text(json.dumps({"real_time_factor": 2.0}))
+
+    assert admission.estimate_seconds(10, 0) == pytest.approx(20)
+
+
+def test_observe_ignores_empty_work():
+    admission.observe(0, 0, 10)
+
+    assert admission.estimate_seconds(100, 0) == pytest.approx(50)
+
+
+def test_admits_everything_when_disabled(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(admission, "MAX_BACKLOG_SECONDS", 0)
+
+    for index in range(10):
+        assert admission.admit(str(index), 1000) is not None
+
+
+def test_rejects_sessions_over_backlog(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(admission, "MAX_BACKLOG_SECONDS", 100)
+
+    # A session larger than the limit is admitted when nothing else runs.
+    assert admission.admit("a", 150) is not None
+    assert admission.admit("b", 10) is None
+    assert admission.get_retry_after() == 51
+
+    admission.release("a")
+
+    assert admission.admit("b", 10) is not None
+
+
+def test_eta_includes_backlog(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(admission, "MAX_BACKLOG_SECONDS", 0)
+    admission.admit("a", 100)
+    eta = admission.admit("b", 50)
+
+    assert eta is not None
+    assert eta - time.time() == pytest.approx(150, abs=1)
@@ -0,0 +1,155 @@
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+import broker
+from broker import SQLiteBroker
+
+
+@pytest.fixture
+def jobs(tmp_path: Path) -> SQLiteBroker:
+    return SQLiteBroker(str(tmp_path / "jobs.db"))
+
+
+def make_stale(jobs: SQLiteBroker, job_id: str):
+    jobs._connect().execute(
+        "UPDATE jobs SET heartbeat = ? WHERE id = ?",
+        (time.time() - broker.STALE_AFTER - 1, job_id),
+    )
+
+
+def test_claims_jobs_in_order(jobs: SQLiteBroker):
+    first = jobs.enqueue("a", {"lang": "en"})
+    second = jobs.enqueue("b", {})
+
+    job = jobs.claim("worker")
+    assert job == {
+        "id": first,
+        "session_id": "a",
+        "payload": {"lang": "en"},
+        "attempts": 1,
+    }
+    job = jobs.claim("worker")
+    assert job is not None and job["id"] == second
+    assert jobs.claim("worker") is None
+
+
+def test_concurrent_claims_get_different_jobs(jobs: SQLiteBroker):
+    for index in range(20):
+        jobs.enqueue(str(index), {})
+    claimed: list[str] = []
+    lock = threading.Lock()
+
+    def work(worker_id: str):
+        while (job := jobs.claim(worker_id)) is not None:
+            with lock:
+                claimed.append(job["id"])
+
+    threads = [threading.Thread(target=work, args=[str(i)]) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(claimed) == len(set(claimed)) == 20
+
+
+def test_heartbeat_only_from_owner(jobs: SQLiteBroker):
+    jobs.enqueue("a", {})
+    job = jobs.claim("owner")
+    assert job is not None
+
+    assert jobs.heartbeat(job["id"], "owner")
+    assert not jobs.heartbeat(job["id"], "other")
+
+
+def test_complete_ignores_other_workers(jobs: SQLiteBroker):
+    jobs.enqueue("a", {})
+    job = jobs.claim("owner")
+    assert job is not None
+
+    jobs.complete(job["id"], "other")
+    assert jobs.heartbeat(job["id"], "owner")
+
+    jobs.complete(job["id"], "owner")
+    assert not jobs.heartbeat(job["id"], "owner")
+
+
+def test_release_requeues_job(jobs: SQLiteBroker):
+    jobs.enqueue("a", {})
+    job = jobs.claim("owner")
+    assert job is not None
+
+    jobs.release(job["id"], "owner")
+
+    job = jobs.claim("other")
+    assert job is not None and job["attempts"] == 2
+
+
+def test_cancel_queued_job(jobs: SQLiteBroker):
+    jobs.enqueue("a", {})
+
+    assert jobs.cancel("a") == "queued"
+    assert jobs.claim("worker") is None
+    assert jobs.cancel("a") is None
+
+
+def test_cancel_running_job(jobs: SQLiteBroker):
+    jobs.enqueue("a", {})
+    job = jobs.claim("worker")
+    assert job is not None
+    assert not jobs.is_cancel_requested(job["id"])
+
+    assert jobs.cancel("a") == "running"
+    assert jobs.is_cancel_requested(job["id"])
+
+
+def test_stale_job_is_requeued_and_leaves_old_owner(jobs: SQLiteBroker):
+    jobs.enqueue("a", {})
+    job = jobs.claim("crashed")
+    assert job is not None
+    make_stale(jobs, job["id"])
+
+    assert jobs.release_stale() == []
+    retried = jobs.claim("other")
+
+    assert retried is not None and retried["id"] == job["id"]
+    assert not jobs.heartbeat(job["id"], "crashed")
+    assert jobs.heartbeat(job["id"], "other")
+
+
+def test_live_job_is_not_requeued(jobs: SQLiteBroker):
+    jobs.enqueue("a", {})
+    jobs.claim("worker")
+
+    jobs.release_stale()
+
+    assert jobs.claim("other") is None
+
+
+def test_gives_up_after_max_attempts(jobs: SQLiteBroker):
+    jobs.enqueue("a", {})
+    for _ in range(broker.MAX_ATTEMPTS - 1):
+        job = jobs.claim("worker")
+        assert job is not None
+        make_stale(jobs, job["id"])
+        assert jobs.release_stale() == []
+
+    job = jobs.claim("worker")
+    assert job is not None
+    make_stale(jobs, job["id"])
+
+    abandoned = jobs.release_stale()
+
+    assert [job["session_id"] for job in abandoned] == ["a"]
+    assert jobs.claim("worker") is None
+
+
+def test_get_broker(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    monkeypatch.delenv("JOB_BROKER", raising=False)
+    assert broker.get_broker() is None
+
+    monkeypatch.setenv("JOB_BROKER", f"sqlite://{tmp_path}/jobs.db")
+    assert isinstance(broker.get_broker(), SQLiteBroker)
@@ -0,0 +1,110 @@
+import threading
+import time
+
+import pytest
+
+import cancellation
+from cancellation import (
+    CancelToken,
+    JobCancelled,
+    JobReassigned,
+    add_audio,
+    cancel_job,
+    check_cancelled,
+    register_job,
+    run_with_token,
+    use_token,
+)
+
+
+def test_check_passes_until_cancelled():
+    token = CancelToken()
+    token.check()
+
+    token.cancel("Stop.")
+
+    with pytest.raises(JobCancelled, match="Stop."):
+        token.check()
+
+
+def test_first_reason_wins():
+    token = CancelToken()
+    token.cancel("First.")
+    token.cancel("Second.")
+
+    assert token.reason == "First."
+
+
+def test_reassigned_job_raises_job_reassigned():
+    token = CancelToken()
+    token.reassign()
+
+    with pytest.raises(JobReassigned):
+        token.check()
+
+
+def test_cancel_job_reaches_registered_token():
+    token = register_job("session")
+
+    assert cancel_job("session")
+    with pytest.raises(JobCancelled):
+        token.check()
+
+
+def test_cancel_job_without_job():
+    assert not cancel_job("unknown")
+
+
+def test_token_is_unregistered_after_run():
+    token = register_job("session")
+
+    with run_with_token("session", token):
+        check_cancelled()
+
+    assert not cancel_job("session")
+
+
+def test_check_cancelled_uses_token_of_current_thread():
+    token = CancelToken()
+    token.cancel()
+    errors = []
+
+    def run():
+        try:
+            check_cancelled()
+        except JobCancelled as e:
+            errors.append(e)
+
+    # Other threads don't see the token unless they use it.
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    assert errors == []
+
+    with use_token(token):
+        with pytest.raises(JobCancelled):
+            check_cancelled()
+    check_cancelled()
+
+
+def test_time_budget_starts_when_job_runs(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(cancellation, "JOB_MAX_SECONDS", 0.05)
+    token = register_job("session")
+
+    # Time spent queued doesn't count.
+    time.sleep(0.1)
+    with run_with_token("session", token):
+        check_cancelled()
+        time.sleep(0.1)
+        with pytest.raises(JobCancelled, match="time budget"):
+            check_cancelled()
+
+
+def test_audio_budget(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(cancellation, "JOB_MAX_AUDIO_SECONDS", 100)
+    token = CancelToken()
+
+    with use_token(token):
+        add_audio(60)
+        with pytest.raises(JobCancelled, match="audio budget"):
+            add_audio(60)
@@ -0,0 +1,154 @@
+import threading
+import time
+from typing import Any
+
+import pytest
+
+import claims
+from timestamp_types import Status
+
+
+def get_fields() -> dict[str, Any]:
+    return {"status": Status.IN_PROGRESS.value, "start": time.time()}
+
+
+class FakeSnapshot:
+    def __init__(self, document: dict[str, Any] | None):
+        self.exists = document is not None
+        self.document = document
+
+    def to_dict(self) -> dict[str, Any] | None:
+        return None if self.document is None else dict(self.document)
+
+
+class FakeDocument:
+    def __init__(self, document: dict[str, Any] | None = None):
+        self.document = document
+
+    def get(self, transaction: Any = None) -> FakeSnapshot:
+        return FakeSnapshot(self.document)
+
+
+class FakeTransaction:
+    def set(self, ref: FakeDocument, fields: dict[str, Any], merge: bool = False):
+        ref.document = {**(ref.document or {}), **fields}
+
+
+def test_claims_new_session():
+    documents: dict[str, dict[str, Any]] = {}
+
+    claimed, previous = claims.claim_local_session(documents, "a", get_fields())
+
+    assert claimed
+    assert previous is None
+    assert documents["a"]["status"] == Status.IN_PROGRESS.value
+
+
+def test_claims_finished_session_and_returns_its_document():
+    documents = {"a": {"status": Status.DONE.value, "timestamps": []}}
+
+    claimed, previous = claims.claim_local_session(documents, "a", get_fields())
+
+    assert claimed
+    assert previous == {"status": Status.DONE.value, "timestamps": []}
+    assert documents["a"]["status"] == Status.IN_PROGRESS.value
+    assert documents["a"]["timestamps"] == []
+
+
+def test_rejects_duplicate_claim():
+    documents: dict[str, dict[str, Any]] = {}
+    first_fields = get_fields()
+    claims.claim_local_session(documents, "a", first_fields)
+
+    claimed, current = claims.claim_local_session(documents, "a", get_fields())
+
+    assert not claimed
+    assert current == first_fields
+
+
+def test_only_one_of_racing_claims_wins():
+    documents: dict[str, dict[str, Any]] = {}
+    results: list[bool] = []
+    barrier = threading.Barrier(8)
+
+    def claim():
+        barrier.wait()
+        results.append(claims.claim_local_session(documents, "a", get_fields())[0])
+
+    threads = [threading.Thread(target=claim) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(results) == [False] * 7 + [True]
+
+
+def test_reclaims_stale_claim(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(claims, "CLAIM_STALE_SECONDS", 60)
+    documents = {"a": {"status": Status.IN_PROGRESS.value, "start": time.time() - 61}}
+
+    claimed, _ = claims.claim_local_session(documents, "a", get_fields())
+
+    assert claimed
+
+
+def test_keeps_fresh_claim(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(claims, "CLAIM_STALE_SECONDS", 60)
+    documents = {"a": {"status": Status.IN_PROGRESS.value, "start": time.time() - 30}}
+
+    claimed, _ = claims.claim_local_session(documents, "a", get_fields())
+
+    assert not claimed
+
+
+def test_never_reclaims_when_disabled(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(claims, "CLAIM_STALE_SECONDS", 0)
+    documents = {"a": {"status": Status.IN_PROGRESS.value, "start": 0}}
+
+    claimed, _ = claims.claim_local_session(documents, "a", get_fields())
+
+    assert not claimed
+
+
+def test_transaction_claims_and_writes_fields():
+    ref = FakeDocument({"status": Status.FAILED.value})
+
+    claimed, previous = claims._claim(FakeTransaction(), ref, get_fields())
+
+    assert claimed
+    assert previous == {"status": Status.FAILED.value}
+    assert ref.document is not None
+    assert ref.document["status"] == Status.IN_PROGRESS.value
+
+
+def test_transaction_rejects_session_in_progress():
+    fields = get_fields()
+    ref = FakeDocument(dict(fields))
+
+    claimed, current = claims._claim(FakeTransaction(), ref, get_fields())
+
+    assert not claimed
+    assert current == fields
+    assert ref.document == fields
+
+
+def test_transaction_reclaims_stale_claim(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(claims, "CLAIM_STALE_SECONDS", 60)
+    ref = FakeDocument({"status": Status.IN_PROGRESS.value, "start": time.time() - 61})
+    fields = get_fields()
+
+    claimed, _ = claims._claim(FakeTransaction(), ref, fields)
+
+    assert claimed
+    assert ref.document == fields
+
+
+def test_coalesces_jobs_in_process():
+    assert claims.start_job("a", {"language": "en"}) is None
+    assert claims.start_job("a", {"language": "fr"}) == {"language": "en"}
+
+    claims.finish_job("a")
+
+    assert claims.start_job("a", {"language": "fr"}) is None
+    claims.finish_job("a")
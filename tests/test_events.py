@@ -0,0 +1,110 @@
+import asyncio
+import json
+import threading
+
+import pytest
+
+import events
+from events import astream, publish, stream, subscribe, unsubscribe
+
+
+@pytest.fixture(autouse=True)
+def bus(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(events, "_subscribers", {})
+    monkeypatch.setattr(events, "_history", {})
+    monkeypatch.setattr(events, "_finished", {})
+
+
+def parse(chunk: str) -> tuple[str, dict]:
+    event, data = chunk.strip().split("\n")
+    return event.removeprefix("event: "), json.loads(data.removeprefix("data: "))
+
+
+def test_subscribers_receive_published_events():
+    subscriber = subscribe("a")
+    publish("a", "stage", {"stage": "align"})
+    publish("b", "stage", {"stage": "convert"})
+
+    progress_event = subscriber.get_nowait()
+    assert progress_event["event"] == "stage"
+    assert progress_event["data"] == {"stage": "align"}
+    assert subscriber.empty()
+
+    unsubscribe("a", subscriber)
+    assert events._subscribers == {}
+
+
+def test_late_subscribers_replay_current_run():
+    publish("a", "started", {"total": 1})
+    publish("a", "file", {"progress": 1})
+    publish("a", "done")
+    publish("a", "started", {"total": 2})
+
+    subscriber = subscribe("a")
+
+    assert subscriber.get_nowait()["data"] == {"total": 2}
+    assert subscriber.empty()
+
+
+def test_history_of_finished_sessions_expires(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(events, "HISTORY_TTL", 0)
+    publish("a", "started")
+    publish("a", "done")
+    publish("b", "started")
+
+    assert "a" not in events._history
+    assert "b" in events._history
+
+
+def test_stream_ends_after_terminal_event():
+    publish("a", "started", {"total": 1})
+    chunks = stream("a")
+
+    event, data = parse(next(chunks))
+    assert event == "started" and data["total"] == 1
+
+    threading.Timer(0.05, publish, ["a", "failed", {"error": "x"}]).start()
+    event, data = parse(next(chunks))
+    assert event == "failed" and data["error"] == "x"
+
+    with pytest.raises(StopIteration):
+        next(chunks)
+    assert events._subscribers == {}
+
+
+def test_stream_sends_keep_alives(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(events, "KEEP_ALIVE_INTERVAL", 0.01)
+    chunks = stream("a")
+
+    assert next(chunks) == ": keep-alive\n\n"
+    chunks.close()
+    assert events._subscribers == {}
+
+
+def test_async_stream_receives_events_from_threads():
+    async def read() -> list[str]:
+        chunks = []
+        threading.Timer(0.05, publish, ["a", "done"]).start()
+        async for chunk in astream("a"):
+            chunks.append(chunk)
+        return chunks
+
+    chunks = asyncio.run(read())
+
+    assert [parse(chunk)[0] for chunk in chunks] == ["done"]
+    assert events._subscribers == {}
+
+
+def test_cancelled_async_stream_unsubscribes():
+    async def read():
+        chunks = astream("a")
+        task = asyncio.ensure_future(chunks.__anext__())
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await chunks.aclose()
+
+    asyncio.run(read())
+
+    assert events._subscribers == {}
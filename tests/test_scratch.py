@@ -0,0 +1,102 @@
+import os
+import subprocess
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+import scratch
+from cancellation import CancelToken, JobCancelled, use_token
+from scratch import clean_orphans, scratch_space
+
+
+@pytest.fixture(autouse=True)
+def root(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> Path:
+    monkeypatch.setattr(scratch, "SCRATCH_DIR", str(tmp_path / "scratch"))
+    monkeypatch.setattr(scratch, "TMPFS_DIR", "")
+    monkeypatch.setattr(scratch, "_reserved", {})
+    return tmp_path / "scratch"
+
+
+def test_folder_is_removed_after_job(root: Path):
+    with scratch_space("session/../a", 10) as folder:
+        assert Path(folder).parent == root
+        assert Path(folder).name.startswith(f"{os.getpid()}-session_.._a-")
+        Path(folder, "file").write_text("data")
+
+    assert not Path(folder).exists()
+    assert scratch._reserved == {str(root): 0}
+
+
+def test_folder_is_removed_when_job_fails():
+    with pytest.raises(ValueError):
+        with scratch_space("a", 10) as folder:
+            raise ValueError()
+
+    assert not Path(folder).exists()
+
+
+def test_waits_for_quota(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(scratch, "SCRATCH_MAX_BYTES", 100)
+    started = threading.Event()
+    events: list[str] = []
+
+    def second_job():
+        started.set()
+        with scratch_space("b", 60):
+            events.append("b")
+
+    with scratch_space("a", 60):
+        thread = threading.Thread(target=second_job)
+        thread.start()
+        started.wait()
+        time.sleep(0.2)
+        events.append("a done")
+    thread.join()
+
+    assert events == ["a done", "b"]
+
+
+def test_job_larger_than_quota_runs_alone(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(scratch, "SCRATCH_MAX_BYTES", 100)
+
+    with scratch_space("a", 1000) as folder:
+        assert Path(folder).is_dir()
+
+
+def test_waiting_job_can_be_cancelled(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(scratch, "SCRATCH_MAX_BYTES", 100)
+    token = CancelToken()
+    errors: list[Exception] = []
+
+    def second_job():
+        with use_token(token):
+            try:
+                with scratch_space("b", 60):
+                    pass
+            except JobCancelled as e:
+                errors.append(e)
+
+    with scratch_space("a", 60):
+        thread = threading.Thread(target=second_job)
+        thread.start()
+        token.cancel()
+        thread.join(timeout=5)
+
+    assert len(errors) == 1
+
+
+def test_clean_orphans_keeps_folders_of_running_processes(root: Path):
+    exited = subprocess.Popen(["true"])
+    exited.wait()
+    root.mkdir(parents=True)
+    orphan = root / f"{exited.pid}-session-x"
+    running = root / f"{os.getppid()}-session-y"
+    other = root / "other"
+    for folder in [orphan, running, other]:
+        folder.mkdir()
+
+    clean_orphans()
+
+    assert sorted(path.name for path in root.iterdir()) == [running.name]
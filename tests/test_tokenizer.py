@@ -0,0 +1,48 @@
+import pytest
+import torch
+
+from mms.align_utils import AudioTooShort, Tokenizer, check_enough_frames, get_tokenizer
+
+DICTIONARY = {"<blank>": 0, "a": 1, "b": 2, "c": 3, "<star>": 4}
+
+
+def test_encodes_lines_with_offsets():
+    encoding = Tokenizer(DICTIONARY).encode(["<star>", "a b", "", "c a b"])
+
+    assert encoding.targets.tolist() == [4, 1, 2, 3, 1, 2]
+    assert encoding.targets.dtype == torch.int32
+    assert encoding.offsets == [0, 1, 3, 3, 6]
+    assert encoding.oov == {}
+
+
+def test_leaves_out_missing_characters():
+    encoding = Tokenizer(DICTIONARY).encode(["a x b x", "y", "c"])
+
+    assert encoding.targets.tolist() == [1, 2, 3]
+    assert encoding.offsets == [0, 2, 2, 3]
+    assert encoding.oov == {0: ["x"], 1: ["y"]}
+
+
+def test_ignores_repeated_spaces():
+    encoding = Tokenizer(DICTIONARY).encode([" a  b "])
+
+    assert encoding.targets.tolist() == [1, 2]
+
+
+def test_labels_are_indexed_by_id():
+    assert Tokenizer(DICTIONARY).labels == ["<blank>", "a", "b", "c", "<star>"]
+
+
+def test_tokenizer_is_built_once_per_dictionary():
+    dictionary = dict(DICTIONARY)
+
+    assert get_tokenizer(dictionary) is get_tokenizer(dictionary)
+    assert get_tokenizer(dictionary) is not get_tokenizer(dict(DICTIONARY))
+
+
+def test_repeated_targets_need_a_blank_between_them():
+    encoding = Tokenizer(DICTIONARY).encode(["a a b"])
+
+    check_enough_frames(torch.zeros(4, len(DICTIONARY)), encoding)
+    with pytest.raises(AudioTooShort):
+        check_enough_frames(torch.zeros(3, len(DICTIONARY)), encoding)
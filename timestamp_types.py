@@ -3,7 +3,7 @@ Types for the timestamping service.
 """
 
 from enum import Enum
-from typing import TypedDict
+from typing import Any, NotRequired, TypedDict
 
 
 class Section(TypedDict):
@@ -17,6 +17,11 @@ class Section(TypedDict):
     end_str: str
     text: str
     uroman_tokens: str
+    # Mean probability of the aligned characters of the section.
+    confidence: NotRequired[float]
+    # Romanized characters of the section missing from the model's dictionary,
+    # which were left out of the alignment.
+    oov: NotRequired[list[str]]
 
 
 class FileTimestamps(TypedDict):
@@ -26,15 +31,36 @@ class FileTimestamps(TypedDict):
 
     audio_file: str
     text_file: str
+    # SHA-256 of the audio file, used to tell whether an incremental
+    # re-alignment can reuse these timestamps.
+    audio_hash: NotRequired[str]
+    # Range of the audio file that was aligned, in seconds.
+    audio_start: NotRequired[float]
+    audio_end: NotRequired[float]
+    # Length of the whole audio file in seconds.
+    audio_duration: NotRequired[float]
     sections: list[Section]
 
 
+class ProgressEvent(TypedDict):
+    """
+    Progress event published while a session is being aligned.
+    """
+
+    event: str
+    time: float
+    data: dict[str, Any]
+
+
 # Info for a file. Elements are name, url, and path.
 File = tuple[str, str, str]
 
 # A match consists of an audio file and a text file.
 Match = tuple[File, File]
 
+# Start and optional end in seconds of the part of an audio file to align.
+AudioRange = tuple[float, float | None]
+
 
 class Status(Enum):
     """
@@ -44,6 +70,7 @@ class Status(Enum):
     IN_PROGRESS = "in_progress"
     DONE = "done"
     FAILED = "failed"
+    CANCELLED = "cancelled"
 
 
 class SessionDoc(TypedDict):
@@ -0,0 +1,121 @@
+"""
+Streaming ingestion of audio and text uploaded directly to the server. Audio is
+decoded to 16kHz WAV by ffmpeg while the upload is still arriving.
+"""
+
+import subprocess
+from pathlib import Path
+from typing import IO, Any
+
+import ffmpeg
+from werkzeug.sansio import multipart
+
+from timestamp_types import File, Match
+
+AUDIO_EXTENSIONS = {"wav", "mp3"}
+TEXT_EXTENSIONS = {"txt", "usfm"}
+
+# Size of the chunks read from the request body.
+CHUNK_SIZE = 64 * 1024
+
+
+class UploadError(Exception):
+    """
+    Raised when an upload is malformed.
+    """
+
+
+class AudioSink:
+    """
+    Decodes audio written to it in chunks to a 16kHz WAV file with ffmpeg.
+    """
+
+    def __init__(self, wav_path: str):
+        self.wav_path = wav_path
+        stream = ffmpeg.input("pipe:0")
+        stream = ffmpeg.output(stream, wav_path, acodec="pcm_s16le", ar=16000)
+        stream = ffmpeg.overwrite_output(stream)
+        self.process: subprocess.Popen = ffmpeg.run_async(
+            stream,
+            pipe_stdin=True,
+            cmd=["ffmpeg", "-loglevel", "error"],  # type: ignore
+        )
+
+    def write(self, data: bytes):
+        assert self.process.stdin is not None
+        self.process.stdin.write(data)
+
+    def close(self):
+        assert self.process.stdin is not None
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise UploadError("Could not decode the uploaded audio.")
+
+    def abort(self):
+        self.process.kill()
+        self.process.wait()
+
+
+def receive_upload(body: IO[bytes], boundary: str, folder: str) -> Match:
+    """
+    Read a multipart body with an `audio` and a `text` file part into `folder`,
+    decoding the audio as it arrives. Returns the match of the two local files,
+    whose URLs use the file:// scheme.
+    """
+    Path(folder).mkdir(parents=True, exist_ok=True)
+    decoder = multipart.MultipartDecoder(boundary.encode())
+    files: dict[str, File] = {}
+    sink: Any = None
+    complete = False
+
+    try:
+        while True:
+            try:
+                event = decoder.next_event()
+            except ValueError as e:
+                raise UploadError(f"Malformed upload: {e}")
+
+            if isinstance(event, multipart.NeedData):
+                if complete:
+                    raise UploadError("The upload ended unexpectedly.")
+                chunk = body.read(CHUNK_SIZE)
+                complete = not chunk
+                decoder.receive_data(chunk or None)
+            elif isinstance(event, multipart.File):
+                name = event.name
+                file_name = Path(event.filename or "").name
+                stem, _, extension = file_name.rpartition(".")
+                extension = extension.lower()
+
+                if name == "audio" and stem and extension in AUDIO_EXTENSIONS:
+                    path = f"{folder}/{stem}.wav"
+                    sink = AudioSink(path)
+                    files[name] = (f"{stem}.wav", f"file://{path}", path)
+                elif name == "text" and stem and extension in TEXT_EXTENSIONS:
+                    path = f"{folder}/{file_name}"
+                    sink = open(path, "wb")
+                    files[name] = (file_name, f"file://{path}", path)
+                else:
+                    raise UploadError(f"Unexpected file {file_name} in {name}.")
+            elif isinstance(event, multipart.Field):
+                # Fields are not used, but their data still has to be consumed.
+                sink = None
+            elif isinstance(event, multipart.Data):
+                if sink is not None:
+                    sink.write(event.data)
+                    if not event.more_data:
+                        sink.close()
+                        sink = None
+            elif isinstance(event, multipart.Epilogue):
+                break
+    except BaseException:
+        if isinstance(sink, AudioSink):
+            sink.abort()
+        elif sink is not None:
+            sink.close()
+        raise
+
+    if "audio" not in files or "text" not in files:
+        raise UploadError("The upload needs an audio and a text file.")
+
+    return files["audio"], files["text"]
@@ -1,17 +1,64 @@
 import os
-import re
+import shutil
+import subprocess
 import time
 import traceback
-from pathlib import Path
-from typing import Any
+from contextlib import nullcontext
+from multiprocessing.dummy import Pool
+from typing import Any, Callable
 
 import ffmpeg
 from halo import Halo
 
+import admission
+import metrics
+import result_cache
+from alignment import (
+    convert_to_wav,
+    load_model_and_dict,
+    read_lines,
+    realign_lines,
+    refine_sections,
+    shift_sections,
+    timestamp_lines,
+)
+from cancellation import (
+    CancelToken,
+    JobCancelled,
+    JobReassigned,
+    add_audio,
+    check_cancelled,
+    get_token,
+    use_token,
+)
+from events import publish
 from firebase import bucket
-from mms.align_utils import get_alignments, get_spans, get_uroman_tokens
-from mms.text_normalization import text_normalize
-from timestamp_types import File, FileTimestamps, Match, Section, Status
+from memory import memory_budget
+from mms.align_utils import DEFAULT_EMISSION_CONFIG, FAST_EMISSION_CONFIG
+from models import DEFAULT_TIER, get_spec
+from profiling import is_profiling
+from scheduler import get_wait_seconds, stage
+from scratch import DEFAULT_SCRATCH_BYTES, scratch_space
+from timestamp_types import (
+    AudioRange,
+    File,
+    FileTimestamps,
+    Match,
+    Status,
+)
+
+# Seconds to wait for the duration of a file when estimating a session.
+PROBE_TIMEOUT = 10
+
+# Number of files of a session probed at once when estimating it.
+PROBE_THREADS = int(os.environ.get("PROBE_THREADS", 8))
+
+# Bytes of scratch space needed per second of audio: the downloaded file and
+# its 16kHz WAV conversion.
+SCRATCH_BYTES_PER_SECOND = 48000
+
+# Number of files of a session aligned at once.
+FILE_PARALLELISM = int(os.environ.get("FILE_PARALLELISM", 2))
 
 
 def match_files(
@@ -51,209 +98,445 @@ def match_files(
     return [match for match in matched_files.values() if None not in match]
 
 
-def align_matches(
-    session_id: str,
+def probe_durations(matches: list[Match], sizes: dict[str, int]) -> dict[str, float]:
+    """
+    Durations in seconds of the audio of matches by file name, given the sizes
+    of their files by path. Audio that can't be probed is estimated from its
+    size.
+    """
+
+    def probe(audio_file: File) -> tuple[str, float]:
+        try:
+            probe = ffmpeg.probe(audio_file[1], timeout=PROBE_TIMEOUT)
+            duration = float(probe["format"]["duration"])
+        except (ffmpeg.Error, subprocess.TimeoutExpired, KeyError, ValueError):
+            duration = sizes.get(audio_file[2], 0) / admission.BYTES_PER_AUDIO_SECOND
+        return audio_file[0], duration
+
+    if not matches:
+        return {}
+
+    # Probing runs in the request, so files are probed at once and without
+    # waiting for the stage slots of running jobs.
+    with Pool(min(PROBE_THREADS, len(matches))) as pool:
+        return dict(pool.map(probe, [audio_file for audio_file, _ in matches]))
+
+
+def get_range_seconds(duration: float, audio_range: AudioRange | None = None) -> float:
+    """
+    Seconds of audio of the given duration that are within a range.
+    """
+    start, end = audio_range or (0, None)
+    return max(0, min(duration, duration if end is None else end) - start)
+
+
+def estimate_matches(
+    matches: list[Match],
+    sizes: dict[str, int],
+    durations: dict[str, float],
+    audio_ranges: dict[str, AudioRange] | None = None,
+) -> float:
+    """
+    Estimated seconds to align matches, given the sizes of their files by path
+    and their audio durations from `probe_durations`.
+    """
+    audio_seconds = 0.0
+    characters = 0
+
+    for audio_file, text_file in matches:
+        audio_seconds += get_range_seconds(
+            durations.get(audio_file[0], 0), (audio_ranges or {}).get(audio_file[0])
+        )
+        # Close enough to the number of characters for estimating.
+        characters += sizes.get(text_file[2], 0)
+
+    return admission.estimate_seconds(audio_seconds, characters)
+
+
+def fetch_file(file: File, destination: str):
+    """
+    Move an uploaded file to `destination`, or download it from the bucket.
+    """
+    _, url, path = file
+    if url.startswith("file://"):
+        shutil.move(path, destination)
+    else:
+        bucket.blob(path).download_to_filename(destination)
+
+
+def align_match(
+    folder: str,
+    match: Match,
     language: str,
     separator: str,
-    session_doc_ref: Any,
-    matches: list[tuple[File, File]],
     model: Any,
     dictionary: Any,
-):
+    on_stage: Callable[[str], None],
+    previous: FileTimestamps | None = None,
+    audio_range: AudioRange | None = None,
+    adaptive: bool = False,
+    tier: str = DEFAULT_TIER,
+) -> FileTimestamps:
     """
-    Align audio and text files and write output to Firestore.
+    Download and align one audio and text file. See `align_matches`.
     """
-    spinner = Halo("Aligning...").start()
+    spinner = Halo()
 
-    file_timestamps: list[FileTimestamps] = []
-    folder = f"/tmp/sessions/{session_id}"
-    Path(folder).mkdir(parents=True, exist_ok=True)
+    audio_output = f"{folder}/{match[0][0]}"
+    audio_type = match[0][0].split(".")[-1]
+    wav_output = audio_output.replace(f".{audio_type}", "_output.wav")
+    text_output = f"{folder}/{match[1][0]}"
 
-    progress = 0
-    session_doc_ref.set({"total": len(matches), "progress": progress}, merge=True)
-    total_length = 0
+    try:
+        spinner.text = f"Downloading audio to {audio_output}..."
+        spinner.start()
+        on_stage("download")
 
-    for match in matches:
-        session_doc_ref.set({"current": match[0][0]}, merge=True)
-        try:
-            audio_output = f"{folder}/{match[0][0]}"
-            audio_type = match[0][0].split(".")[-1]
+        with stage("io"):
+            fetch_file(match[0], audio_output)
+
+        spinner.succeed(f"Audio downloaded to {audio_output}.")
 
-            spinner.text = f"Downloading audio to {audio_output}..."
+        spinner.text = f"Downloading text to {text_output}..."
+        spinner.start()
+        with stage("io"):
+            fetch_file(match[1], text_output)
+        spinner.succeed(f"Text downloaded to {text_output}.")
+
+        audio_duration = float(ffmpeg.probe(audio_output)["streams"][0]["duration"])
+        audio_start, audio_end = audio_range or (0, None)
+        audio_end = (
+            audio_duration if audio_end is None else min(audio_end, audio_duration)
+        )
+        add_audio(audio_end - audio_start)
+
+        audio_hash = result_cache.hash_file(audio_output)
+        cache_key = result_cache.make_key(
+            audio_hash,
+            text_output,
+            language,
+            separator,
+            (audio_start, audio_end),
+            "adaptive" if adaptive else "",
+            get_spec(tier).version,
+        )
+        sections = result_cache.get(cache_key)
+
+        if sections is not None:
+            spinner.succeed("Found cached alignment.")
+            on_stage("cached")
+        else:
+            start = time.perf_counter()
+            wait_seconds = get_wait_seconds()
+            spinner.text = f"Converting audio to {wav_output}..."
             spinner.start()
+            on_stage("convert")
+
+            # Uploads are decoded to 16kHz WAV while they are received.
+            is_decoded = match[0][1].startswith("file://")
+            if is_decoded and audio_start == 0 and audio_end == audio_duration:
+                os.replace(audio_output, wav_output)
+            else:
+                with stage("transcode"):
+                    convert_to_wav(
+                        audio_output,
+                        wav_output,
+                        audio_start,
+                        audio_end - audio_start,
+                    )
+            spinner.succeed(f"Audio converted to {wav_output}.")
+
+            lines_to_timestamp = read_lines(text_output, separator)
+
+            characters = sum(len(line) for line in lines_to_timestamp)
+            # Waveforms, emissions and alignment paths of concurrent files
+            # have to fit in memory together.
+            with memory_budget(audio_end - audio_start, characters):
+                if (
+                    previous is not None
+                    and previous.get("audio_hash") == audio_hash
+                    and previous.get("audio_start", 0) == audio_start
+                    and previous.get("audio_end", audio_duration) == audio_end
+                ):
+                    sections = realign_lines(
+                        wav_output,
+                        shift_sections(previous["sections"], -audio_start),
+                        lines_to_timestamp,
+                        language,
+                        model,
+                        dictionary,
+                        spinner,
+                        on_stage,
+                    )
+
+                if sections is None:
+                    sections = timestamp_lines(
+                        wav_output,
+                        lines_to_timestamp,
+                        language,
+                        model,
+                        dictionary,
+                        spinner,
+                        on_stage,
+                        FAST_EMISSION_CONFIG if adaptive else DEFAULT_EMISSION_CONFIG,
+                    )
+                    if adaptive:
+                        sections = refine_sections(
+                            wav_output,
+                            sections,
+                            language,
+                            model,
+                            dictionary,
+                            spinner,
+                            on_stage,
+                        )
+                    # Only full runs are cached so that cached results never
+                    # depend on the history of a session.
+                    sections = shift_sections(sections, audio_start)
+                    result_cache.put(cache_key, sections)
+                    # Time spent waiting for other jobs isn't work of this one.
+                    seconds = (
+                        time.perf_counter()
+                        - start
+                        - (get_wait_seconds() - wait_seconds)
+                    )
+                    admission.observe(audio_end - audio_start, characters, seconds)
+                    metrics.increment(f"models.{tier}.files")
+                    metrics.increment(
+                        f"models.{tier}.audio_seconds", audio_end - audio_start
+                    )
+                    metrics.increment(f"models.{tier}.seconds", seconds)
+                else:
+                    sections = shift_sections(sections, audio_start)
+    except Exception:
+        spinner.fail(f"Failed to align {match[0][0]}.")
+        raise
+    finally:
+        for path in [wav_output, audio_output, text_output]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    spinner.succeed(f"Alignment of {match[0][0]} done.")
+
+    return {
+        "audio_file": match[0][0],
+        "text_file": match[1][0],
+        "audio_hash": audio_hash,
+        "audio_start": audio_start,
+        "audio_end": audio_end,
+        "audio_duration": audio_duration,
+        "sections": sections,
+    }
+
+
+def schedule_matches(
+    matches: list[Match],
+    durations: dict[str, float] | None = None,
+    audio_ranges: dict[str, AudioRange] | None = None,
+) -> list[int]:
+    """
+    Order in which to align matches, as indices: longest audio first, so that
+    a long file started last doesn't dominate the time the session takes.
+    Matches without a known duration keep their order at the end.
+    """
+    return sorted(
+        range(len(matches)),
+        key=lambda index: -get_range_seconds(
+            (durations or {}).get(matches[index][0][0], 0),
+            (audio_ranges or {}).get(matches[index][0][0]),
+        ),
+    )
+
+
+def report_failure(
+    session_id: str,
+    session_doc_ref: Any,
+    audio_file: str | None,
+    error: Exception,
+    token: CancelToken | None,
+):
+    """
+    Mark a session as cancelled or failed after `error` stopped it. Jobs that
+    were reassigned to another worker raise JobReassigned instead, since the
+    session belongs to the new owner.
+    """
+    spinner = Halo()
 
-            bucket.blob(match[0][2]).download_to_filename(audio_output)
+    if token is not None and token.reassigned:
+        spinner.warn("Alignment reassigned to another worker.")
+        raise JobReassigned(str(error))
 
-            spinner.succeed(f"Audio downloaded to {audio_output}.")
+    if isinstance(error, JobCancelled):
+        spinner.fail(f"Alignment cancelled: {error}")
+        session_doc_ref.set(
+            {
+                "status": Status.CANCELLED.value,
+                "error": str(error),
+                "end": time.time(),
+            },
+            merge=True,
+        )
+        publish(session_id, "cancelled", {"file": audio_file, "error": str(error)})
+    else:
+        spinner.fail("Failed to align.")
+        session_doc_ref.set(
+            {"status": Status.FAILED.value, "error": str(error)},
+            merge=True,
+        )
+        publish(session_id, "failed", {"file": audio_file, "error": str(error)})
 
-            wav_output = audio_output.replace(f".{audio_type}", "_output.wav")
 
-            spinner.text = f"Converting audio to {wav_output}..."
-            spinner.start()
+def align_matches(
+    session_id: str,
+    language: str,
+    separator: str,
+    session_doc_ref: Any,
+    matches: list[tuple[File, File]],
+    previous_timestamps: dict[str, FileTimestamps] | None = None,
+    audio_ranges: dict[str, AudioRange] | None = None,
+    adaptive: bool = False,
+    durations: dict[str, float] | None = None,
+    tier: str = DEFAULT_TIER,
+):
+    """
+    Align audio and text files and write output to Firestore.
 
-            total_length += float(ffmpeg.probe(audio_output)["streams"][0]["duration"])
-            stream = ffmpeg.input(audio_output)
-            stream = ffmpeg.output(stream, wav_output, acodec="pcm_s16le", ar=16000)
-            stream = ffmpeg.overwrite_output(stream)
-            ffmpeg.run(
-                stream,
-                overwrite_output=True,
-                cmd=["ffmpeg", "-loglevel", "error"],  # type: ignore
-            )
-            spinner.succeed(f"Audio downloaded and converted to {wav_output}.")
-
-            text_output = f"{folder}/{match[1][0]}"
-            spinner.text = f"Downloading text to {text_output}..."
-            spinner.start()
-            bucket.blob(match[1][2]).download_to_filename(text_output)
-            spinner.succeed(f"Text downloaded to {text_output}.")
+    `previous_timestamps` holds the results of a previous run by audio file
+    name. Files whose audio is unchanged since then are re-aligned
+    incrementally, only over the lines that changed.
 
-            spinner.text = "Normalizing and romanizing... "
-            spinner.start()
+    `audio_ranges` restricts the alignment of an audio file, by name, to the
+    part between a start and an optional end time in seconds. Timestamps are
+    still relative to the start of the file.
 
-            text_extension = match[1][0].split(".")[-1]
-
-            text_file = open(text_output, "r", encoding="utf-8")
-            lines_to_timestamp = []
-
-            if text_extension == "txt":
-                # Read the separator from the query parameter and adjust
-                # it so it can be used in the split function.
-                if separator == "lineBreak":
-                    separator = "\n"
-                elif separator == "squareBracket":
-                    separator = "["
-                elif separator == "downArrow":
-                    separator = "⬇️"
-
-                lines_to_timestamp = text_file.read().split(separator)
-
-                # Add back in square bracket or custom separator to the beginning of
-                # each line if it was removed.
-                if separator == "[":
-                    lines_to_timestamp = [
-                        f"[{line}" for line in lines_to_timestamp if line.strip() != ""
-                    ]
-                elif separator != "\n" and separator != "⬇️":
-                    lines_to_timestamp = [
-                        f"{separator}{line}"
-                        for line in lines_to_timestamp
-                        if line.strip() != ""
-                    ]
-            elif text_extension == "usfm":
-                # Define the tags to ignore
-                ignore_tags = [
-                    "\\c",
-                    "\\p",
-                    "\\s",
-                    "\\s1",
-                    "\\s2",
-                    "\\f",
-                    "\\ft",
-                    "\\fr",
-                    "\\x",
-                    "\\xt",
-                    "\\xo",
-                    "\\r",
-                    "\\t",
-                    "\\m",
-                ]
-
-                # Compile a regex to match tags we want to ignore
-                ignore_regex = re.compile(
-                    r"|".join(re.escape(tag) for tag in ignore_tags)
-                )
-                current_verse = ""
-                for line in text_file:
-                    if ignore_regex.match(line.strip()):
-                        continue
-
-                    if line.startswith(r"\v"):  # USFM verse marker
-                        if current_verse:
-                            cleaned_verse = re.sub(
-                                r"\\[a-z]+\s?", "", current_verse.strip()
-                            )
-                            lines_to_timestamp.append(cleaned_verse)
-                        current_verse = line.strip()  # Start a new verse
-                    else:
-                        current_verse += " " + line.strip()
-
-                if current_verse:  # Append the last verse after the loop
-                    cleaned_verse = re.sub(r"\\[a-z]+\s?", "", current_verse.strip())
-                    lines_to_timestamp.append(cleaned_verse)
-
-            norm_lines_to_timestamp = [
-                text_normalize(line.strip(), language) for line in lines_to_timestamp
-            ]
-            uroman_lines_to_timestamp = get_uroman_tokens(
-                norm_lines_to_timestamp, language
-            )
-            uroman_lines_to_timestamp = ["<star>"] + uroman_lines_to_timestamp
-            lines_to_timestamp = ["<star>"] + lines_to_timestamp
-            norm_lines_to_timestamp = ["<star>"] + norm_lines_to_timestamp
-            spinner.succeed("Text normalized and romanized.")
-
-            spinner.text = "Aligning..."
-            spinner.start()
+    With `adaptive`, files are aligned with fast emission settings first and
+    only low-confidence sections are re-aligned with accurate settings.
 
-            segments, stride = get_alignments(
-                wav_output,
-                uroman_lines_to_timestamp,
-                model,
-                dictionary,
-            )
-
-            spans = get_spans(uroman_lines_to_timestamp, segments)
-
-            sections = []
-
-            for i, t in enumerate(lines_to_timestamp):
-                span = spans[i]
-                seg_start_idx = span[0].start
-                seg_end_idx = span[-1].end
-
-                audio_start_sec = seg_start_idx * stride / 1000
-                audio_end_sec = seg_end_idx * stride / 1000
-
-                section: Section = {
-                    "begin": audio_start_sec,
-                    "end": audio_end_sec,
-                    "begin_str": time.strftime(
-                        "%H:%M:%S", time.gmtime(audio_start_sec)
-                    ),
-                    "end_str": time.strftime("%H:%M:%S", time.gmtime(audio_end_sec)),
-                    "text": t,
-                    "uroman_tokens": uroman_lines_to_timestamp[i],
-                }
-
-                sections.append(section)
-        except Exception as e:
-            spinner.fail("Failed to align.")
-            print(traceback.format_exc())
-            session_doc_ref.set(
-                {"status": Status.FAILED.value, "error": str(e)},
-                merge=True,
-            )
-            return
+    Up to FILE_PARALLELISM files are aligned at once, longest first according
+    to the audio `durations` by file name. Results keep the order of `matches`.
 
-        spinner.succeed("Alignment done.")
+    Files are aligned with the model of `tier`, loaded if needed.
+    """
+    # Files report their own progress, possibly at the same time.
+    spinner = Halo()
 
-        spinner.text = "Cleaning up..."
-        spinner.start()
-        os.remove(wav_output)
-        os.remove(audio_output)
-        os.remove(text_output)
-        spinner.succeed("Cleaned up.")
+    order = schedule_matches(matches, durations, audio_ranges)
+    file_timestamps: list[FileTimestamps | None] = [None] * len(matches)
 
-        file_timestamps.append(
-            {
-                "audio_file": match[0][0],
-                "text_file": match[1][0],
-                "sections": sections,
-            }
+    progress = 0
+    session_doc_ref.set(
+        {
+            "total": len(matches),
+            "progress": progress,
+            "current": matches[order[0]][0][0] if matches else None,
+        },
+        merge=True,
+    )
+
+    token = get_token()
+    # Profiling is scoped to the job thread, so profiled jobs align files on it.
+    parallelism = 1 if is_profiling() else FILE_PARALLELISM
+
+    def align(index: int) -> tuple[int, FileTimestamps | Exception]:
+        match = matches[index]
+
+        def on_stage(stage: str):
+            # Stage boundaries are where a cancelled job stops.
+            check_cancelled()
+            publish(session_id, "stage", {"file": match[0][0], "stage": stage})
+
+        try:
+            with use_token(token):
+                # Tiers other than the default are loaded by their first job.
+                model, dictionary = load_model_and_dict(tier)
+                return index, align_match(
+                    folder,
+                    match,
+                    language,
+                    separator,
+                    model,
+                    dictionary,
+                    on_stage,
+                    (previous_timestamps or {}).get(match[0][0]),
+                    (audio_ranges or {}).get(match[0][0]),
+                    adaptive,
+                    tier,
+                )
+        except Exception as e:
+            if not isinstance(e, JobCancelled):
+                print(traceback.format_exc())
+            return index, e
+
+    # The longest files are aligned at the same time at most, each with its
+    # download and converted WAV.
+    scratch_bytes = DEFAULT_SCRATCH_BYTES
+    if durations:
+        scratch_bytes = int(
+            sum(sorted(durations.values(), reverse=True)[:parallelism])
+            * SCRATCH_BYTES_PER_SECOND
         )
-        progress += 1
-        session_doc_ref.set({"progress": progress}, merge=True)
+
+    failure: tuple[str | None, Exception] | None = None
+    try:
+        with scratch_space(f"session-{session_id}", scratch_bytes) as folder, (
+            Pool(parallelism) if parallelism > 1 else nullcontext()
+        ) as pool:
+            results = pool.imap_unordered(align, order) if pool else map(align, order)
+
+            for index, result in results:
+                if isinstance(result, Exception):
+                    # Stop the files that are still running, and wait for them
+                    # before their folder is removed.
+                    if token is not None:
+                        token.cancel(str(result))
+                    if pool:
+                        pool.close()
+                        pool.join()
+                    failure = matches[index][0][0], result
+                    break
+
+                file_timestamps[index] = result
+                progress += 1
+                publish(
+                    session_id,
+                    "file",
+                    {"progress": progress, "total": len(matches), "timestamps": result},
+                )
+                # Progress and the first unfinished file are written together
+                # to keep the number of Firestore writes per file down to one.
+                current = next(
+                    (matches[i][0][0] for i in order if file_timestamps[i] is None),
+                    None,
+                )
+                session_doc_ref.set(
+                    {"progress": progress, "current": current},
+                    merge=True,
+                )
+    except JobCancelled as e:
+        # Cancelled while waiting for scratch space.
+        failure = None, e
+    finally:
+        # Uploads that weren't moved into the scratch folder, e.g. of files
+        # that never started, are removed with the job unless another worker
+        # took it over.
+        if token is None or not token.reassigned:
+            for match in matches:
+                for _, url, path in match:
+                    if url.startswith("file://"):
+                        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+    if failure is not None:
+        report_failure(session_id, session_doc_ref, *failure, token)
+        return
+
+    spinner.succeed("Alignment done.")
+
+    results = [timestamps for timestamps in file_timestamps if timestamps is not None]
+    # Length of the audio files, and of the parts of them that were aligned.
+    total_length = sum(timestamps["audio_duration"] for timestamps in results)
+    aligned_length = sum(
+        timestamps["audio_end"] - timestamps["audio_start"] for timestamps in results
+    )
 
     doc_spinner = Halo("Uploading to Firestore...").start()
     session_doc_ref.set(
@@ -262,7 +545,13 @@ def align_matches(
             "status": Status.DONE.value,
             "end": time.time(),
             "total_length": total_length,
+            "aligned_length": aligned_length,
         },
         merge=True,
     )
     doc_spinner.succeed("Uploaded to Firestore.")
+    publish(
+        session_id,
+        "done",
+        {"total_length": total_length, "aligned_length": aligned_length},
+    )
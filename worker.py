@@ -0,0 +1,149 @@
+"""
+Standalone worker that runs alignment jobs from the job broker configured with
+JOB_BROKER. Start more workers against the same broker to add capacity:
+
+    JOB_BROKER=sqlite:///shared/jobs.db python worker.py
+"""
+
+import os
+import socket
+import threading
+import time
+import traceback
+
+from halo import Halo
+
+from alignment import load_model_and_dict
+from broker import Job, get_broker
+from cancellation import CancelToken, JobReassigned, register_job, run_with_token
+from firebase import db
+from profiling import profile_job
+from scratch import clean_orphans
+from timestamp_types import Status
+from utils import align_matches, report_failure
+
+# Seconds between heartbeats of a running job.
+HEARTBEAT_INTERVAL = 10
+
+# Seconds to wait before polling the broker again when the queue is empty.
+POLL_INTERVAL = 2
+
+broker = get_broker()
+assert broker is not None, "JOB_BROKER is not set"
+
+worker_id = f"{socket.gethostname()}-{os.getpid()}"
+clean_orphans()
+# Other tiers are loaded by the first job that uses them.
+load_model_and_dict()
+
+
+def send_heartbeats(job: Job, token: CancelToken, stop: threading.Event):
+    """
+    Send heartbeats for a job until `stop` is set, and cancel it when that is
+    requested through the broker.
+    """
+    assert broker is not None
+    while not stop.wait(HEARTBEAT_INTERVAL):
+        if broker.is_cancel_requested(job["id"]):
+            token.cancel()
+        if not broker.heartbeat(job["id"], worker_id):
+            print(f"Job {job['id']} was reassigned to another worker.")
+            token.reassign()
+            return
+
+
+def run_job(job: Job):
+    """
+    Run an alignment job while sending heartbeats for it.
+    """
+    assert broker is not None
+    payload = dict(job["payload"])
+    profile = payload.pop("profile", False)
+    session_doc_ref = db.collection("sessions").document(job["session_id"])
+
+    token = register_job(job["session_id"])
+    stop = threading.Event()
+    heartbeat_thread = threading.Thread(
+        target=send_heartbeats, args=[job, token, stop], daemon=True
+    )
+    heartbeat_thread.start()
+
+    try:
+        with run_with_token(job["session_id"], token), profile_job(
+            job["session_id"], profile
+        ):
+            align_matches(
+                job["session_id"],
+                session_doc_ref=session_doc_ref,
+                **{
+                    **payload,
+                    # Tuples are stored as lists in the payload.
+                    "matches": [
+                        (tuple(audio), tuple(text))
+                        for audio, text in payload["matches"]
+                    ],
+                    "audio_ranges": {
+                        name: (audio_range[0], audio_range[1])
+                        for name, audio_range in payload.get("audio_ranges", {}).items()
+                    },
+                },
+            )
+        broker.complete(job["id"], worker_id)
+    except KeyboardInterrupt:
+        # Hand the job back so another worker can pick it up right away
+        # instead of waiting for its heartbeat to go stale.
+        broker.release(job["id"], worker_id)
+        raise
+    except JobReassigned:
+        # The job and its session belong to another worker now.
+        pass
+    except Exception as e:
+        print(traceback.format_exc())
+        broker.complete(job["id"], worker_id, failed=True)
+        # Tell the client, which would otherwise see the session in progress.
+        try:
+            report_failure(job["session_id"], session_doc_ref, None, e, token)
+        except JobReassigned:
+            pass
+        except Exception:
+            print(traceback.format_exc())
+    finally:
+        stop.set()
+        heartbeat_thread.join()
+
+
+def fail_abandoned_jobs():
+    """
+    Requeue jobs of crashed workers and mark the sessions of jobs that
+    crashed too many workers as failed.
+    """
+    assert broker is not None
+    for job in broker.release_stale():
+        db.collection("sessions").document(job["session_id"]).set(
+            {
+                "status": Status.FAILED.value,
+                "error": "The alignment job crashed too many times.",
+            },
+            merge=True,
+        )
+
+
+def main():
+    assert broker is not None
+    spinner = Halo(f"Worker {worker_id} waiting for jobs...").start()
+
+    while True:
+        fail_abandoned_jobs()
+        job = broker.claim(worker_id)
+
+        if job is None:
+            time.sleep(POLL_INTERVAL)
+            continue
+
+        spinner.info(f"Running job {job['id']} for session {job['session_id']}.")
+        run_job(job)
+        spinner.start(f"Worker {worker_id} waiting for jobs...")
+
+
+if __name__ == "__main__":
+    main()